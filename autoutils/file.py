@@ -3,12 +3,49 @@
 """
 __author__ = ('Reza Zeiny <rezazeiny1998@gmail.com>',)
 
+import asyncio
+import bz2
 import gzip
+import hashlib
+import io
 import json
 import logging
+import lzma
 import os
 import pickle
+import shutil
+from functools import partial
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from enum import Enum
+from itertools import islice
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logger = logging.getLogger(__name__)
 
@@ -23,14 +60,168 @@ class FileModes(Enum):
     OBJECT = "object"
     FILE = "file"
     APPEND = "append"
+    JSONL = "jsonl"
+    MSGPACK = "msgpack"
+
+
+class Compressions(Enum):
+    """
+        Compression of Files
+    """
+    NONE = "none"
+    GZIP = "gzip"
+    BZ2 = "bz2"
+    XZ = "xz"
+    ZSTD = "zstd"
+
 
+COMPRESSION_EXTENSIONS = {
+    ".gz": Compressions.GZIP,
+    ".gzip": Compressions.GZIP,
+    ".bz2": Compressions.BZ2,
+    ".xz": Compressions.XZ,
+    ".lzma": Compressions.XZ,
+    ".zst": Compressions.ZSTD,
+    ".zstd": Compressions.ZSTD,
+}
 
-def read_file(address, file_mode=FileModes.NORMAL):
+
+def get_compression(address, compression=None) -> Compressions:
+    """
+        Compression of file. from compression if given else from file extension
+    Args:
+        address (str): file address
+        compression (Compressions): forced compression
+
+    Returns:
+        (Compressions) : compression of file
+    """
+    if compression is not None:
+        return Compressions(compression)
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(str(address))[1].lower(), Compressions.NONE)
+
+
+def open_file(address, mode: str = "r", compression=None, *, compress_level: int = None,
+              compress_threads: int = None):
+    """
+        Open file and (de)compress it transparently
+    Args:
+        address (str): file address
+        mode (str): open mode like builtin open
+        compression (Compressions): compression of file. None means from file extension
+        compress_level (int): compression level. None means codec default
+        compress_threads (int): compression threads (zstd only). -1 means all cores
+
+    Returns:
+        file object
+    """
+    compression = get_compression(address, compression)
+    if compression == Compressions.NONE:
+        return open(address, mode)
+    mode = mode.replace("+", "")
+    binary_mode = mode.replace("t", "") if "b" in mode else mode.replace("t", "") + "b"
+    if compression == Compressions.ZSTD:
+        if zstandard is None:
+            raise ImportError("zstandard package is needed for zstd files")
+        if binary_mode.startswith("r"):
+            file = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+                open(address, "rb"), read_across_frames=True, closefd=True))
+        else:
+            compressor = zstandard.ZstdCompressor(level=3 if compress_level is None else compress_level,
+                                                  threads=compress_threads or 0)
+            file = compressor.stream_writer(open(address, binary_mode), closefd=True)
+        return file if "b" in mode else io.TextIOWrapper(file, encoding="UTF-8")
+    text_mode = mode if "b" in mode else mode.replace("t", "") + "t"
+    kwargs = {"encoding": "UTF-8"} if "b" not in mode else {}
+    if compression == Compressions.GZIP:
+        if compress_level is not None:
+            kwargs["compresslevel"] = compress_level
+        return gzip.open(address, text_mode, **kwargs)
+    if compression == Compressions.BZ2:
+        if compress_level is not None:
+            kwargs["compresslevel"] = compress_level
+        return bz2.open(address, text_mode, **kwargs)
+    if compress_level is not None and not text_mode.startswith("r"):
+        kwargs["preset"] = compress_level
+    return lzma.open(address, text_mode, **kwargs)
+
+
+def _dump_json_line(record) -> str:
+    """
+        Compact one line json. use orjson if installed
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def _load_json_line(line: str):
+    """
+        Decode one json line. use orjson if installed
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except ValueError:
+            pass
+    return json.loads(line)
+
+
+def iter_file(address, file_mode=FileModes.NORMAL, compression=None):
+    """
+        Lazy iterate over lines of file. invalid records are logged and skipped
+    Args:
+        address (str): file address
+        file_mode (FileModes): NORMAL, GZIP or JSONL
+        compression (Compressions): compression of file. None means from file extension
+
+    Yields:
+        stripped line or decoded json record
+    """
+    if file_mode not in [FileModes.NORMAL, FileModes.GZIP, FileModes.JSONL]:
+        raise ValueError(f"{file_mode} can not be iterated")
+    if file_mode == FileModes.GZIP:
+        with gzip.open(address) as file:
+            for line in file:
+                try:
+                    yield line.strip().decode("UTF-8")
+                except UnicodeDecodeError:
+                    pass
+        return
+    with open_file(address, "r", compression) as file:
+        if file_mode == FileModes.NORMAL:
+            for line in file:
+                yield line.strip()
+            return
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield _load_json_line(line)
+            except ValueError as e:
+                logger.error(f"invalid json line {line_number} in {address} e: {e}")
+
+
+def _load_msgpack(file):
+    """
+        Load msgpack data
+    """
+    if msgpack is None:
+        raise ImportError("msgpack package is needed for MSGPACK mode")
+    return msgpack.unpack(file, raw=False, strict_map_key=False)
+
+
+def read_file(address, file_mode=FileModes.NORMAL, compression=None):
     """
         easy way to read file
     Args:
         address (str): file address
         file_mode (FileModes): mode of reading
+        compression (Compressions): compression of file. None means from file extension (except FILE mode
+            that reads raw bytes unless compression is given)
 
     Returns:
         file data
@@ -40,23 +231,21 @@ def read_file(address, file_mode=FileModes.NORMAL):
         return None
     logger.debug(f"reading file. addr: {address} {file_mode}")
     mode = "r"
-    if file_mode in [FileModes.OBJECT, FileModes.FILE]:
+    if file_mode in [FileModes.OBJECT, FileModes.FILE, FileModes.MSGPACK]:
         mode = "rb"
+    if file_mode == FileModes.FILE and compression is None:
+        compression = Compressions.NONE
     try:
-        if file_mode == FileModes.GZIP:
-            with gzip.open(address) as file:
-                file_data = []
-                for line in file.readlines():
-                    try:
-                        file_data.append(line.strip().decode("UTF-8"))
-                    except UnicodeDecodeError:
-                        pass
+        if file_mode in [FileModes.GZIP, FileModes.JSONL]:
+            file_data = list(iter_file(address, file_mode, compression))
         else:
-            with open(address, mode) as file:
+            with open_file(address, mode, compression) as file:
                 if file_mode == FileModes.JSON:
                     file_data = json.load(file)
                 elif file_mode == FileModes.OBJECT:
                     file_data = pickle.load(file)
+                elif file_mode == FileModes.MSGPACK:
+                    file_data = _load_msgpack(file)
                 elif file_mode == FileModes.FILE:
                     file_data = file.read()
                 elif file_mode == FileModes.NORMAL:
@@ -69,13 +258,260 @@ def read_file(address, file_mode=FileModes.NORMAL):
         return None
 
 
-def write_file(address: str, data, file_mode=FileModes.NORMAL) -> bool:
+class FileCache:
+    """
+        LRU cache of parsed files for read_file. entries are revalidated with os.stat (inode, mtime, size) on
+        every read, so changed files are read again. cached data is shared between callers, don't change it
+    """
+
+    racy_seconds = 1.0
+
+    def __init__(self, max_bytes: int = 64 << 20):
+        """
+
+        Args:
+            max_bytes (int): max total size of cached files (size on disk)
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._mutex = threading.Lock()
+
+    def read(self, address, file_mode=FileModes.NORMAL, compression=None):
+        """
+            read_file through cache
+        """
+        if address is None:
+            return None
+        key = (os.path.abspath(address), file_mode, compression)
+        try:
+            stat = os.stat(address)
+        except OSError:
+            self._pop(key)
+            return read_file(address, file_mode, compression)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._mutex:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        file_data = read_file(address, file_mode, compression)
+        # a file changed within the mtime resolution may change again with the same signature
+        if file_data is None or time.time() - stat.st_mtime < self.racy_seconds or stat.st_size > self.max_bytes:
+            self._pop(key)
+            return file_data
+        with self._mutex:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self._entries[key] = (signature, stat.st_size, file_data)
+            self.size += stat.st_size
+            while self.size > self.max_bytes:
+                _, (_, size, _) = self._entries.popitem(last=False)
+                self.size -= size
+        return file_data
+
+    def _pop(self, key):
+        with self._mutex:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def invalidate(self, address):
+        """
+            Remove all cached modes of address
+        """
+        address = os.path.abspath(address)
+        with self._mutex:
+            for key in [key for key in self._entries if key[0] == address]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        """
+            Remove all entries
+        """
+        with self._mutex:
+            self._entries.clear()
+            self.size = 0
+
+
+file_cache = FileCache()
+
+
+def read_file_cached(address, file_mode=FileModes.NORMAL, compression=None):
+    """
+        read_file with the module file_cache. parsed data is returned again while the file is unchanged
+    """
+    return file_cache.read(address, file_mode, compression)
+
+
+def read_files(addresses, file_mode=FileModes.NORMAL, workers: int = 8, *, processes: bool = False,
+               ordered: bool = True, max_in_flight: int = None, compression=None):
+    """
+        Read many files concurrently
+    Args:
+        addresses: iterable of file addresses
+        file_mode (FileModes): mode of reading
+        workers (int): number of threads or processes
+        processes (bool): decode in processes. better for cpu heavy (gzip, json) decoding of many files
+        ordered (bool): yield in input order. otherwise yield as soon as each file is read
+        max_in_flight (int): max files read but not yet yielded. default is twice workers
+        compression (Compressions): compression of files. None means from file extension
+
+    Yields:
+        (address, file data) . file data is None if reading failed
+    """
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+    max_in_flight = max(max_in_flight, 1)
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    addresses = iter(addresses)
+    with executor_class(max_workers=workers) as executor:
+        in_flight = deque()
+        for address in islice(addresses, max_in_flight):
+            in_flight.append((address, executor.submit(read_file, address, file_mode, compression)))
+        while in_flight:
+            if ordered:
+                address, future = in_flight.popleft()
+                result = future.result()
+            else:
+                done, _ = wait([future for _, future in in_flight], return_when=FIRST_COMPLETED)
+                address, future = next(item for item in in_flight if item[1] in done)
+                in_flight.remove((address, future))
+                result = future.result()
+            for next_address in islice(addresses, 1):
+                in_flight.append((next_address, executor.submit(read_file, next_address, file_mode, compression)))
+            yield address, result
+
+
+_append_sync_counter = {}
+_append_sync_mutex = threading.Lock()
+
+
+def _fsync_directory(directory: str):
+    """
+        Persist a rename inside directory (no-op where directories can't be opened)
+    """
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+def _fsync_file(address: str):
+    """
+        Persist content of a closed file. compressed streams write their last block and trailer on close, so
+        fsync inside their with block misses the end of file
+    """
+    fd = os.open(address, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _need_append_sync(address: str, fsync_every: int) -> bool:
+    """
+        Count appends of address and tell if this one should be synced
+    """
+    key = os.path.abspath(address)
+    with _append_sync_mutex:
+        count = _append_sync_counter.get(key, 0) + 1
+        if count >= fsync_every:
+            _append_sync_counter.pop(key, None)
+            return True
+        _append_sync_counter[key] = count
+        return False
+
+
+def _write_data(file, data, file_mode):
+    """
+        Write data to an opened file
+    """
+    if file_mode == FileModes.JSON:
+        json.dump(data, file, indent=4, sort_keys=True, ensure_ascii=False)
+    elif file_mode == FileModes.OBJECT:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+    elif file_mode == FileModes.MSGPACK:
+        if msgpack is None:
+            raise ImportError("msgpack package is needed for MSGPACK mode")
+        msgpack.pack(data, file, use_bin_type=True)
+    elif file_mode == FileModes.FILE:
+        file.write(data)
+    elif file_mode == FileModes.JSONL:
+        _write_lines(file, map(_dump_json_line, data))
+    else:
+        _write_lines(file, data)
+
+
+def _write_lines(file, lines, chunk_lines: int = 4096):
+    """
+        Write lines in joined chunks instead of one write call per line
+    """
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_lines))
+        if not chunk:
+            return
+        file.write("\n".join(map(str, chunk)) + "\n")
+
+
+def _atomic_write(address: str, data, file_mode, mode: str, fsync: bool, compression: Compressions, **kwargs):
+    """
+        Write to a temp file beside address and rename it over address
+    """
+    directory = os.path.dirname(os.path.abspath(address))
+    while True:
+        temp_address = os.path.join(directory, f".{os.path.basename(address)}.{os.urandom(6).hex()}.tmp")
+        try:
+            # 0o666 lets kernel apply current umask, like a plain open of a new file
+            os.close(os.open(temp_address, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            break
+        except FileExistsError:
+            continue
+    try:
+        with open_file(temp_address, mode, compression, **kwargs) as file:
+            _write_data(file, data, file_mode)
+        if fsync:
+            _fsync_file(temp_address)
+        if os.path.exists(address):
+            os.chmod(temp_address, os.stat(address).st_mode & 0o7777)
+        os.replace(temp_address, address)
+    except BaseException:
+        remove_file_if_exists(temp_address)
+        raise
+    if fsync:
+        _fsync_directory(directory)
+
+
+def write_file(address: str, data, file_mode=FileModes.NORMAL, compression=None, *, append: bool = False,
+               atomic: bool = False, fsync: bool = False, fsync_every: int = None, compress_level: int = None,
+               compress_threads: int = None) -> bool:
     """
         Write or append easily to file
     Args:
         address (str): file address
         data: data
         file_mode (FileModes): file mode
+        compression (Compressions): compression of file. None means from file extension (except FILE mode
+            that writes raw bytes unless compression is given)
+        append (bool): append lines or records to end of file in NORMAL and JSONL mode
+        atomic (bool): write to a temp file in the same directory and rename it over address, so readers never
+            see a half written file. ignored when appending
+        fsync (bool): flush data to disk before returning (and the rename, in atomic mode)
+        fsync_every (int): when appending, fsync only once per this many appends to the same address
+        compress_level (int): compression level. None means codec default
+        compress_threads (int): compression threads (zstd only). -1 means all cores
 
     Returns:
         (bool) : job state
@@ -85,25 +521,31 @@ def write_file(address: str, data, file_mode=FileModes.NORMAL) -> bool:
 
     if type(data) == str and file_mode in [FileModes.APPEND, FileModes.NORMAL]:
         data = [data]
+    if type(data) == dict and file_mode == FileModes.JSONL:
+        data = [data]
 
+    append = file_mode == FileModes.APPEND or (append and file_mode in [FileModes.NORMAL, FileModes.JSONL])
     mode = "w"
-    if file_mode == FileModes.APPEND:
+    if append:
         mode = "a+"
-    elif file_mode in [FileModes.OBJECT, FileModes.FILE]:
+    elif file_mode in [FileModes.OBJECT, FileModes.FILE, FileModes.MSGPACK]:
         mode = "wb"
+    if file_mode == FileModes.FILE and compression is None:
+        compression = Compressions.NONE
     logger.debug(f"mode: {file_mode}, addr: {address}")
 
     try:
-        with open(address, mode) as file:
-            if file_mode == FileModes.JSON:
-                json.dump(data, file, indent=4, sort_keys=True, ensure_ascii=False)
-            elif file_mode == FileModes.OBJECT:
-                pickle.dump(data, file)
-            elif file_mode == FileModes.FILE:
-                file.write(data)
-            else:
-                for line in data:
-                    file.write(str(line) + "\n")
+        compression = get_compression(address, compression)
+        compress_kwargs = {"compress_level": compress_level, "compress_threads": compress_threads}
+        if atomic and not append:
+            _atomic_write(address, data, file_mode, mode, fsync, compression, **compress_kwargs)
+        else:
+            with open_file(address, mode, compression, **compress_kwargs) as file:
+                _write_data(file, data, file_mode)
+            if append and fsync_every is not None:
+                fsync = _need_append_sync(address, fsync_every)
+            if fsync:
+                _fsync_file(address)
         logger.debug(f"{file_mode} is complete. addr: {address}")
 
         return True
@@ -112,6 +554,300 @@ def write_file(address: str, data, file_mode=FileModes.NORMAL) -> bool:
     return False
 
 
+class FileWriter:
+    """
+        Buffered line writer. keep file open and write lines in large chunks
+
+        with FileWriter("out.log") as writer:
+            for line in lines:
+                writer.write(line)
+    """
+
+    def __init__(self, address: str, append: bool = True, buffer_size: int = 1 << 20, *, fsync: bool = False,
+                 compression=None, compress_level: int = None, compress_threads: int = None):
+        """
+
+        Args:
+            address (str): file address
+            append (bool): append to file or truncate it on open
+            buffer_size (int): flush when buffered characters reach this size
+            fsync (bool): fsync file on every flush
+            compression (Compressions): compression of file. None means from file extension
+            compress_level (int): compression level. None means codec default
+            compress_threads (int): compression threads (zstd only). -1 means all cores
+        """
+        self.address = address
+        self.append = append
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.compression = get_compression(address, compression)
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
+        self.file = None
+        self.line_count = 0
+        self.char_count = 0
+        self.start_time = None
+        self._buffer = []
+        self._buffer_size = 0
+
+    def open(self) -> "FileWriter":
+        """
+            Open file. called by context manager
+        """
+        if self.file is None:
+            self.file = open_file(self.address, "a" if self.append else "w", self.compression,
+                                  compress_level=self.compress_level, compress_threads=self.compress_threads)
+            self.start_time = time.perf_counter()
+        return self
+
+    def write(self, line):
+        """
+            Buffer one line
+        """
+        line = str(line)
+        self._buffer.append(line)
+        self._buffer_size += len(line) + 1
+        if self._buffer_size >= self.buffer_size:
+            self.flush()
+
+    def write_lines(self, lines):
+        """
+            Buffer many lines
+        """
+        for line in lines:
+            self.write(line)
+
+    def write_record(self, record):
+        """
+            Buffer one compact json line (JSONL)
+        """
+        self.write(_dump_json_line(record))
+
+    def flush(self):
+        """
+            Write buffered lines to file
+        """
+        if self.file is None:
+            self.open()
+        if self._buffer:
+            self.file.write("\n".join(self._buffer) + "\n")
+            self.line_count += len(self._buffer)
+            self.char_count += self._buffer_size
+            self._buffer = []
+            self._buffer_size = 0
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """
+            Flush buffer and close file
+        """
+        if self.file is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+            self.file = None
+        if self.fsync and self.compression != Compressions.NONE:
+            # last block and trailer of compressed stream are written on close
+            _fsync_file(self.address)
+        logger.debug(f"writer closed. addr: {self.address} {self.get_stats()}")
+
+    def get_stats(self) -> dict:
+        """
+            Written lines and characters and write throughput
+        """
+        duration = time.perf_counter() - self.start_time if self.start_time is not None else 0
+        return {
+            "lines": self.line_count,
+            "chars": self.char_count,
+            "duration": duration,
+            "lines_per_second": self.line_count / duration if duration else 0,
+            "chars_per_second": self.char_count / duration if duration else 0,
+        }
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_async_io_workers = 4
+_async_io_executor = None
+_async_io_mutex = threading.Lock()
+
+
+def set_async_io_workers(workers: int):
+    """
+        Set size of the thread pool used by async file functions
+    """
+    global _async_io_workers, _async_io_executor
+    with _async_io_mutex:
+        _async_io_workers = workers
+        if _async_io_executor is not None:
+            _async_io_executor.shutdown(wait=False)
+            _async_io_executor = None
+
+
+def _get_async_io_executor() -> ThreadPoolExecutor:
+    global _async_io_executor
+    with _async_io_mutex:
+        if _async_io_executor is None:
+            _async_io_executor = ThreadPoolExecutor(max_workers=_async_io_workers,
+                                                    thread_name_prefix="autoutils-file-io")
+        return _async_io_executor
+
+
+async def _run_io(func, *args, **kwargs):
+    """
+        Run blocking file function on the async io thread pool
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_async_io_executor(), partial(func, *args, **kwargs))
+
+
+async def async_read_file(address, file_mode=FileModes.NORMAL, compression=None):
+    """
+        read_file without blocking the event loop
+    """
+    return await _run_io(read_file, address, file_mode, compression)
+
+
+async def async_write_file(address: str, data, file_mode=FileModes.NORMAL, compression=None, **kwargs) -> bool:
+    """
+        write_file without blocking the event loop. kwargs are passed to write_file
+    """
+    return await _run_io(write_file, address, data, file_mode, compression, **kwargs)
+
+
+async def async_iter_file(address, file_mode=FileModes.NORMAL, compression=None, batch_size: int = 1000):
+    """
+        iter_file without blocking the event loop. lines are read in batches of batch_size on the io thread pool
+    """
+    iterator = iter_file(address, file_mode, compression)
+    try:
+        while True:
+            batch = await _run_io(list, islice(iterator, batch_size))
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        await _run_io(iterator.close)
+
+
+def _load_follow_offset(offset_address, inode):
+    """
+        Saved offset of followed file. 0 if saved state is of another inode (file rotated while stopped, so all of
+        the new file is unread). None if there is no saved state
+    """
+    if offset_address is None or not os.path.exists(offset_address):
+        return None
+    state = read_file(offset_address, FileModes.JSON)
+    if not isinstance(state, dict):
+        return None
+    if state.get("inode") != inode:
+        return 0
+    return state.get("offset")
+
+
+def _wait_for_change(watcher, poll_interval: float):
+    """
+        Sleep until inotify event in file directory or poll_interval
+    """
+    if watcher is None:
+        time.sleep(poll_interval)
+    else:
+        watcher.read(timeout=int(poll_interval * 1000))
+
+
+def follow_file(address: str, *, from_start: bool = False, poll_interval: float = 1.0, offset_address: str = None,
+                stop_event: threading.Event = None, use_inotify: bool = True):
+    """
+        Yield lines appended to a growing file (like tail -F). follow rotated (new inode) and truncated files
+    Args:
+        address (str): file address
+        from_start (bool): start from beginning of file instead of its end (if no saved offset)
+        poll_interval (float): seconds between checks. max wait for an inotify event
+        offset_address (str): save offset of yielded lines in this file, and continue from it on restart
+        stop_event (threading.Event): stop following when set
+        use_inotify (bool): wait on inotify events if inotify_simple is installed
+
+    Yields:
+        (str) : new line without line break
+    """
+    watcher = None
+    if use_inotify and inotify_simple is not None:
+        watcher = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        watcher.add_watch(os.path.dirname(os.path.abspath(address)),
+                          flags.MODIFY | flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM)
+    file = None
+    inode = None
+    offset = 0
+    remainder = b""
+    first_open = True
+    try:
+        while stop_event is None or not stop_event.is_set():
+            if file is None:
+                try:
+                    file = open(address, "rb")
+                except FileNotFoundError:
+                    _wait_for_change(watcher, poll_interval)
+                    continue
+                inode = os.fstat(file.fileno()).st_ino
+                offset = _load_follow_offset(offset_address, inode) if first_open else None
+                if offset is None:
+                    offset = 0 if from_start or not first_open else os.fstat(file.fileno()).st_size
+                first_open = False
+                file.seek(offset)
+                logger.debug(f"follow file. addr: {address} inode: {inode} offset: {offset}")
+
+            data = file.read()
+            if data:
+                lines = (remainder + data).split(b"\n")
+                remainder = lines.pop()
+                if lines:
+                    offset = file.tell() - len(remainder)
+                    for line in lines:
+                        yield line.decode("UTF-8", errors="replace")
+                    if offset_address is not None:
+                        write_file(offset_address, {"inode": inode, "offset": offset}, FileModes.JSON, atomic=True)
+                continue
+
+            try:
+                stat = os.stat(address)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != inode:
+                logger.info(f"followed file rotated. addr: {address}")
+                # rest of old file (written just before rotation) and its last line without line break
+                lines = (remainder + file.read()).split(b"\n")
+                file.close()
+                file = None
+                remainder = b""
+                if lines[-1] == b"":
+                    lines.pop()
+                for line in lines:
+                    yield line.decode("UTF-8", errors="replace")
+                continue
+            if stat.st_size < file.tell():
+                logger.info(f"followed file truncated. addr: {address}")
+                file.seek(0)
+                offset = 0
+                remainder = b""
+                continue
+            _wait_for_change(watcher, poll_interval)
+    finally:
+        if file is not None:
+            file.close()
+        if watcher is not None:
+            watcher.close()
+
+
 def remove_file_if_exists(path) -> bool:
     """
         Remove File if exists
@@ -124,3 +860,153 @@ def remove_file_if_exists(path) -> bool:
         os.remove(path)
         return True
     return False
+
+
+def _pread(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _copy_range(source_fd: int, destination_fd: int, offset: int, size: int, chunk_size: int) -> int:
+    """
+        Copy source bytes from offset to size into destination at the same offset.
+        use copy_file_range, then sendfile and then buffered copy. a method that fails or stops before size
+        (some file systems copy 0 bytes) is replaced by the next one. return position copy stopped at
+    """
+    methods = [method for method in ("copy_file_range", "sendfile") if hasattr(os, method)] + ["buffered"]
+    position = offset
+    os.lseek(destination_fd, position, os.SEEK_SET)
+    while position < size:
+        method = methods[0]
+        count = min(size - position, 1 << 30)
+        try:
+            if method == "copy_file_range":
+                copied = os.copy_file_range(source_fd, destination_fd, count, position, position)
+                os.lseek(destination_fd, position + copied, os.SEEK_SET)
+            elif method == "sendfile":
+                copied = os.sendfile(destination_fd, source_fd, position, count)
+            else:
+                data = memoryview(_pread(source_fd, min(count, chunk_size), position))
+                copied = len(data)
+                while data:
+                    data = data[os.write(destination_fd, data):]
+        except OSError as e:
+            if len(methods) == 1:
+                raise
+            logger.debug(f"{method} failed, fallback. e: {e}")
+            copied = 0
+        if copied == 0:
+            if len(methods) == 1:
+                break
+            logger.debug(f"{method} stopped at {position} of {size}, fallback")
+            methods.pop(0)
+            os.lseek(destination_fd, position, os.SEEK_SET)
+            continue
+        position += copied
+    return position
+
+
+def _resume_offset(source_fd: int, destination_fd: int, source_size: int, chunk_size: int) -> int:
+    """
+        Size of destination if it looks like a partial copy of source (its last chunk matches source) else 0
+    """
+    destination_size = os.fstat(destination_fd).st_size
+    if destination_size == 0 or destination_size > source_size:
+        return 0
+    check_size = min(chunk_size, destination_size)
+    check_offset = destination_size - check_size
+    if _pread(source_fd, check_size, check_offset) != _pread(destination_fd, check_size, check_offset):
+        return 0
+    return destination_size
+
+
+def copy_file(source: str, destination: str, *, resume: bool = False, chunk_size: int = 1 << 20) -> bool:
+    """
+        Copy file content in chunks. use zero copy (copy_file_range or sendfile) where available
+    Args:
+        source (str): source file address
+        destination (str): destination file address
+        resume (bool): if destination is a partial copy of source (checked by its last chunk), continue from its end
+        chunk_size (int): buffer size of fallback copy and size of resume check
+
+    Returns:
+        (bool) : copy state
+    """
+    logger.debug(f"copy file. src: {source} dst: {destination}")
+    try:
+        with open(source, "rb") as source_file:
+            source_fd = source_file.fileno()
+            source_stat = os.fstat(source_fd)
+            source_size = source_stat.st_size
+            destination_fd = os.open(destination, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                destination_stat = os.fstat(destination_fd)
+                if (source_stat.st_dev, source_stat.st_ino) == (destination_stat.st_dev, destination_stat.st_ino):
+                    # same path or a hardlink. truncating destination would wipe source
+                    raise shutil.SameFileError(f"{source} and {destination} are the same file")
+                offset = _resume_offset(source_fd, destination_fd, source_size, chunk_size) if resume else 0
+                if offset:
+                    logger.info(f"resume copy of {source} from {offset}")
+                os.ftruncate(destination_fd, offset)
+                copied = _copy_range(source_fd, destination_fd, offset, source_size, chunk_size)
+                os.ftruncate(destination_fd, copied)
+            finally:
+                os.close(destination_fd)
+        if copied != source_size:
+            logger.error(f"copy file {source} to {destination} is short. copied {copied} of {source_size} bytes")
+            return False
+        logger.debug(f"copy file is complete. src: {source} dst: {destination}")
+        return True
+    except Exception as e:
+        logger.error(f"copy file {source} to {destination} failed e: {e}")
+        return False
+
+
+def _new_hash(algorithm: str):
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ImportError("xxhash package is needed for xxhash checksums")
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def checksum_file(address: str, algorithm: str = "sha256", chunk_size: int = 1 << 20) -> str:
+    """
+        Streaming checksum of file
+    Args:
+        address (str): file address
+        algorithm (str): hashlib algorithm (md5, sha256, blake2b, ...) or xxhash one (xxh64, xxh3_64, xxh3_128)
+        chunk_size (int): read size
+
+    Returns:
+        (str) : hex digest. None if reading failed
+    """
+    try:
+        file_hash = _new_hash(algorithm)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        with open(address, "rb", buffering=0) as file:
+            while True:
+                count = file.readinto(buffer)
+                if not count:
+                    break
+                file_hash.update(view[:count])
+        return file_hash.hexdigest()
+    except Exception as e:
+        logger.error(f"checksum of file {address} failed e: {e}")
+        return None
+
+
+def checksum_files(addresses, algorithm: str = "sha256", chunk_size: int = 1 << 20, workers: int = 4) -> dict:
+    """
+        Checksum many files in parallel threads (hash functions release the GIL on large chunks)
+
+    Returns:
+        (dict) : address to hex digest
+    """
+    addresses = list(addresses)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(partial(checksum_file, algorithm=algorithm, chunk_size=chunk_size), addresses)
+        return dict(zip(addresses, digests))
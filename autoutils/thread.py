@@ -3,19 +3,902 @@
 """
 __author__ = ('Reza Zeiny <rezazeiny1998@gmail.com>',)
 
+import heapq
 import logging
 import multiprocessing
+import os
+import pickle
+import sys
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, TimeoutError
 from concurrent.futures.thread import ThreadPoolExecutor
 from datetime import datetime
-from queue import Queue, Empty
-from threading import Thread, Lock
+from functools import partial
+from itertools import count, islice
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event, Condition, get_ident, local
 
-from func_timeout import func_timeout
 from func_timeout.exceptions import FunctionTimedOut
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
 logger = logging.getLogger(__name__)
 
 
+class DeadlineExceeded(Exception):
+    """
+        Task waited in queue longer than its deadline
+    """
+
+
+class TaskRejected(Exception):
+    """
+        Task is not accepted because queue of pool is full
+    """
+
+
+class TaskFuture:
+    """
+        Result handle of a ThreadPool task
+    """
+    __slots__ = ("task_id", "_status", "_result", "_exception", "_callbacks", "_event", "_mutex")
+
+    def __init__(self, task_id: int):
+        self.task_id = task_id
+        # lock of this future only, so threads finishing different tasks do not wait for each other
+        self._mutex = Lock()
+        self._status = "pending"
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._event = None
+
+    def __repr__(self):
+        return f"<TaskFuture {self.task_id} {self._status}>"
+
+    def done(self) -> bool:
+        """
+            Task is finished or cancelled
+        """
+        return self._status in ("finished", "cancelled")
+
+    def running(self) -> bool:
+        return self._status == "running"
+
+    def cancelled(self) -> bool:
+        return self._status == "cancelled"
+
+    def cancel(self) -> bool:
+        """
+            Cancel task if it is not started yet
+        """
+        if self._status == "cancelled":
+            return True
+        return self._finish("cancelled", exception=CancelledError(), only_pending=True)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+            Wait for task to finish. return False on timeout
+        """
+        with self._mutex:
+            if self.done():
+                return True
+            if self._event is None:
+                self._event = Event()
+            event = self._event
+        return event.wait(timeout)
+
+    def result(self, timeout: float = None):
+        """
+            Result of task. raise task exception (or TimeoutError if not finished in timeout)
+        """
+        if not self.wait(timeout):
+            raise TimeoutError(f"task {self.task_id} is not finished")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout: float = None):
+        """
+            Exception of task or None
+        """
+        if not self.wait(timeout):
+            raise TimeoutError(f"task {self.task_id} is not finished")
+        return self._exception
+
+    def add_done_callback(self, func):
+        """
+            Call func(future) when task is finished. called now if it is already finished
+        """
+        with self._mutex:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        self._call(func)
+
+    def _set_running(self) -> bool:
+        with self._mutex:
+            if self._status != "pending":
+                return False
+            self._status = "running"
+            return True
+
+    def _set_result(self, result=None, exception: BaseException = None):
+        self._finish("finished", result, exception)
+
+    def _finish(self, status: str, result=None, exception: BaseException = None, only_pending: bool = False) -> bool:
+        with self._mutex:
+            if only_pending and self._status != "pending":
+                return False
+            self._status = status
+            self._result = result
+            self._exception = exception
+            event = self._event
+            callbacks = self._callbacks
+            self._callbacks = []
+        if event is not None:
+            event.set()
+        for func in callbacks:
+            self._call(func)
+        return True
+
+    def _call(self, func):
+        try:
+            func(self)
+        except Exception as e:
+            logger.exception(f"Error in done callback of task {self.task_id}. e: {e}")
+
+
+_wall_clock_offset = time.time() - time.perf_counter_ns() / 1e9
+
+
+def _ns_to_datetime(value: int):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(_wall_clock_offset + value / 1e9)
+
+
+class TaskOptions:
+    """
+        Function with scheduling options. pass it instead of function to add_task
+
+        pool.add_task(TaskOptions(func, priority=10, deadline=2, group="api"), *args)
+    """
+    __slots__ = ("func", "timeout", "priority", "deadline", "group", "drop_expired")
+
+    def __init__(self, func, *, timeout: float = None, priority: int = 0, deadline: float = None, group=None,
+                 drop_expired: bool = False):
+        """
+
+        Args:
+            func: task function
+            timeout (float): max run time in seconds
+            priority (int): bigger priority runs first (inside its group)
+            deadline (float): max seconds task may wait in queue before it starts
+            group: name of group. groups share workers round robin
+            drop_expired (bool): cancel expired task silently instead of failing it with DeadlineExceeded
+        """
+        self.func = func
+        self.timeout = timeout
+        self.priority = priority
+        self.deadline = deadline
+        self.group = group
+        self.drop_expired = drop_expired
+
+
+class TaskRecord:
+    """
+        Detail of a ThreadPool task. fields can also be read like a dict (record["status"]).
+        times are time.perf_counter_ns values. *_dt properties convert them to datetime
+    """
+    __slots__ = ("id", "name", "status", "insert_ns", "start_ns", "end_ns", "result", "future", "timeout",
+                 "priority", "deadline_ns", "group", "drop_expired")
+
+    def __init__(self, task_id: int, future: TaskFuture, options: TaskOptions = None, name: str = None):
+        self.id = task_id
+        self.name = name
+        self.status = "pending"
+        self.insert_ns = time.perf_counter_ns()
+        self.start_ns = None
+        self.end_ns = None
+        self.result = None
+        self.future = future
+        self.timeout = None
+        self.priority = 0
+        self.deadline_ns = None
+        self.group = None
+        self.drop_expired = False
+        if options is not None:
+            self.timeout = options.timeout
+            self.priority = options.priority
+            self.group = options.group
+            self.drop_expired = options.drop_expired
+            if options.deadline is not None:
+                self.deadline_ns = self.insert_ns + int(options.deadline * 1e9)
+
+    @property
+    def insert_dt(self) -> datetime:
+        return _ns_to_datetime(self.insert_ns)
+
+    @property
+    def start_dt(self) -> datetime:
+        return _ns_to_datetime(self.start_ns)
+
+    @property
+    def end_dt(self) -> datetime:
+        return _ns_to_datetime(self.end_ns)
+
+    def __repr__(self):
+        return f"<TaskRecord {self.id} {self.status}>"
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self) -> dict:
+        data = {key: getattr(self, key) for key in self.__slots__}
+        data.update(insert_dt=self.insert_dt, start_dt=self.start_dt, end_dt=self.end_dt)
+        return data
+
+
+class Histogram:
+    """
+        Fixed buckets histogram of durations in seconds
+    """
+    __slots__ = ("bounds", "buckets", "count", "total", "max")
+
+    default_bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, bounds: tuple = default_bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        for index, bucket_count in enumerate(other.buckets):
+            self.buckets[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def to_dict(self) -> dict:
+        """
+            count, sum, max, avg and cumulative buckets by upper bound (like prometheus "le")
+        """
+        cumulative = {}
+        total = 0
+        for bound, bucket_count in zip(self.bounds + ("+Inf",), self.buckets):
+            total += bucket_count
+            cumulative[str(bound)] = total
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "avg": self.total / self.count if self.count else 0,
+            "buckets": cumulative,
+        }
+
+
+def _task_name(func) -> str:
+    """
+        Name of task function used in metrics
+    """
+    if isinstance(func, partial):
+        func = func.func
+    return getattr(func, "__qualname__", None) or type(func).__name__
+
+
+class FunctionStats:
+    """
+        Counters and duration histograms of finished tasks of one function
+    """
+    __slots__ = ("counters", "queue_wait", "run_time")
+
+    def __init__(self):
+        self.counters = {}
+        self.queue_wait = Histogram()
+        self.run_time = Histogram()
+
+    def add(self, status: str, queue_wait: float = None, run_time: float = None):
+        self.counters[status] = self.counters.get(status, 0) + 1
+        if queue_wait is not None:
+            self.queue_wait.add(queue_wait)
+        if run_time is not None:
+            self.run_time.add(run_time)
+
+    def merge(self, other: "FunctionStats"):
+        # list() copies items at once, other may be updated by its thread meanwhile
+        for status, status_count in list(other.counters.items()):
+            self.counters[status] = self.counters.get(status, 0) + status_count
+        self.queue_wait.merge(other.queue_wait)
+        self.run_time.merge(other.run_time)
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "queue_wait": self.queue_wait.to_dict(),
+            "run_time": self.run_time.to_dict(),
+        }
+
+
+class _StatsShard(FunctionStats):
+    """
+        Stats of tasks finished by one thread
+    """
+    __slots__ = ("functions",)
+
+    def __init__(self):
+        super().__init__()
+        self.functions = {}
+
+    def add_task(self, name: str, status: str, queue_wait: float = None, run_time: float = None):
+        self.add(status, queue_wait, run_time)
+        if name is not None:
+            function = self.functions.get(name)
+            if function is None:
+                function = self.functions[name] = FunctionStats()
+            function.add(status, queue_wait, run_time)
+
+
+class PoolStats:
+    """
+        Aggregated counters of finished tasks, in total and by function name. kept even when task records are
+        evicted. every thread adds to its own shard, so finishing a task takes no lock. shards are merged on read
+    """
+    __slots__ = ("events", "created", "_mutex", "_shards")
+
+    statuses = ("done", "error", "timeout", "not_run", "cancelled", "expired", "dropped", "rejected")
+
+    def __init__(self):
+        self.events = {"scale_up": 0, "scale_down": 0}
+        self.created = time.monotonic()
+        self._mutex = Lock()
+        self._shards = {}
+
+    def add(self, record: TaskRecord):
+        status = record.status
+        queue_wait = None if record.start_ns is None else (record.start_ns - record.insert_ns) / 1e9
+        run_time = (record.end_ns - record.start_ns) / 1e9 if status in ("done", "error", "timeout") else None
+        shard = self._shards.get(get_ident())
+        if shard is None:
+            with self._mutex:
+                shard = self._shards.setdefault(get_ident(), _StatsShard())
+        shard.add_task(record.name, status, queue_wait, run_time)
+
+    def tasks_per_second(self, current: dict, previous: dict = None) -> float:
+        """
+            Finished tasks per second between two to_dict snapshots (or since creation without previous). each
+            collector keeps its own previous snapshot, so collectors do not change each other's rate
+        """
+        if previous is None:
+            previous = {"finished": 0, "timestamp": self.created}
+        return (current["finished"] - previous["finished"]) / max(current["timestamp"] - previous["timestamp"], 1e-9)
+
+    def add_event(self, event: str):
+        with self._mutex:
+            self.events[event] = self.events.get(event, 0) + 1
+
+    def to_dict(self, functions: bool = False) -> dict:
+        total = FunctionStats()
+        total.counters = dict.fromkeys(self.statuses, 0)
+        by_function = {}
+        for shard in list(self._shards.values()):
+            total.merge(shard)
+            if functions:
+                for name, function in list(shard.functions.items()):
+                    merged = by_function.get(name)
+                    if merged is None:
+                        merged = by_function[name] = FunctionStats()
+                    merged.merge(function)
+        data = total.to_dict()
+        data["finished"] = sum(total.counters.values())
+        data["timestamp"] = time.monotonic()
+        with self._mutex:
+            data["events"] = dict(self.events)
+        if functions:
+            data["functions"] = {name: function.to_dict() for name, function in by_function.items()}
+        return data
+
+
+class TaskQueue:
+    """
+        Queue of ThreadPool with the interface of queue.Queue. tasks of a group are ordered by priority (then
+        insert order) and groups take turns round robin. put(None) adds a stop sentinel which get returns only
+        after all tasks
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.not_full = Condition(self.mutex)
+        self.all_tasks_done = Condition(self.mutex)
+        self.unfinished_tasks = 0
+        self._groups = {}
+        self._turns = deque()
+        self._size = 0
+        self._sentinels = 0
+        self._sequence = count()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self._size
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        """
+            Put task (record, func, args, kwargs) or None sentinel
+        """
+        with self.not_full:
+            if item is None:
+                self._sentinels += 1
+            else:
+                if self.maxsize > 0 and self._size >= self.maxsize:
+                    if not block:
+                        raise Full
+                    if not self.not_full.wait_for(lambda: self._size < self.maxsize, timeout):
+                        raise Full
+                record = item[0]
+                heap = self._groups.get(record.group)
+                if heap is None:
+                    heap = self._groups[record.group] = []
+                    self._turns.append(record.group)
+                heapq.heappush(heap, (-record.priority, next(self._sequence), item))
+                self._size += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block: bool = True, timeout: float = None, worker: "Worker" = None):
+        """
+            Get next task or None sentinel
+        """
+        with self.not_empty:
+            if self._size == 0 and self._sentinels == 0:
+                if not block:
+                    raise Empty
+                if not self.not_empty.wait_for(lambda: self._size or self._sentinels, timeout):
+                    raise Empty
+            if self._size == 0:
+                self._sentinels -= 1
+                return None
+            group = self._turns.popleft()
+            heap = self._groups[group]
+            item = heapq.heappop(heap)[2]
+            if heap:
+                self._turns.append(group)
+            else:
+                del self._groups[group]
+            self._size -= 1
+            self.not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def pop_oldest(self):
+        """
+            Remove and return the oldest waiting task (by insert order)
+        """
+        with self.mutex:
+            if self._size == 0:
+                raise Empty
+            group, index = min(((group, index) for group, heap in self._groups.items() for index in range(len(heap))),
+                               key=lambda position: self._groups[position[0]][position[1]][1])
+            heap = self._groups[group]
+            item = heap[index][2]
+            heap[index] = heap[-1]
+            heap.pop()
+            heapq.heapify(heap)
+            if not heap:
+                del self._groups[group]
+                self._turns.remove(group)
+            self._size -= 1
+            self.not_full.notify()
+            return item
+
+    def task_done(self):
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - 1
+            if unfinished < 0:
+                raise ValueError("task_done() called too many times")
+            if unfinished == 0:
+                self.all_tasks_done.notify_all()
+            self.unfinished_tasks = unfinished
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def unregister(self, worker: "Worker"):
+        """
+            Worker left the pool
+        """
+
+
+class _WorkerSlot:
+    __slots__ = ("tasks", "wakeup", "closed")
+
+    def __init__(self):
+        self.tasks = deque()
+        self.wakeup = Event()
+        self.closed = False
+
+
+_NO_TASK = object()
+
+
+class StealingTaskQueue:
+    """
+        Work stealing queue of ThreadPool with the interface of TaskQueue. every worker has its own deque, tasks
+        are put round robin to deques and an idle worker steals from the others, so workers do not contend on one
+        lock. priority and groups of tasks are ignored (deadline and timeout are not).
+        unfinished tasks and free places are counted by items of deques (append and pop are atomic), locks are
+        only taken when a caller waits for them
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self.all_tasks_done = Condition(Lock())
+        self.not_full = Condition(Lock())
+        self._unfinished = deque()
+        self._joiners = 0
+        self._free_places = deque([None] * maxsize) if maxsize > 0 else None
+        self._put_waiters = 0
+        self._slots = []
+        self._worker_slots = {}
+        self._slots_mutex = Lock()
+        self._overflow = deque()
+        self._sleepers = set()
+        self._sentinels = 0
+        self._sentinels_mutex = Lock()
+        self._round_robin = count()
+
+    @property
+    def unfinished_tasks(self) -> int:
+        return len(self._unfinished)
+
+    def qsize(self) -> int:
+        return sum(len(slot.tasks) for slot in self._slots) + len(self._overflow)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.qsize()
+
+    def _get_slot(self, worker: "Worker") -> _WorkerSlot:
+        slot = self._worker_slots.get(worker)
+        if slot is None:
+            with self._slots_mutex:
+                slot = self._worker_slots[worker] = _WorkerSlot()
+                self._slots = self._slots + [slot]
+        return slot
+
+    def unregister(self, worker: "Worker"):
+        """
+            Worker left the pool. move its tasks to shared overflow deque
+        """
+        with self._slots_mutex:
+            slot = self._worker_slots.pop(worker, None)
+            if slot is None:
+                return
+            slot.closed = True
+            self._slots = [item for item in self._slots if item is not slot]
+        self._drain(slot)
+
+    def _drain(self, slot: _WorkerSlot):
+        while True:
+            try:
+                self._overflow.append(slot.tasks.popleft())
+            except IndexError:
+                break
+            self._wake_one()
+
+    def _wake_one(self):
+        if self._sleepers:
+            try:
+                self._sleepers.pop().wakeup.set()
+            except KeyError:
+                pass
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        """
+            Put task (record, func, args, kwargs) or None sentinel
+        """
+        if item is None:
+            self._unfinished.append(None)
+            with self._sentinels_mutex:
+                self._sentinels += 1
+            for slot in list(self._sleepers):
+                slot.wakeup.set()
+            return
+        if self._free_places is not None:
+            try:
+                self._free_places.pop()
+            except IndexError:
+                self._wait_free_place(block, timeout)
+        self._unfinished.append(None)
+        slots = self._slots
+        if not slots:
+            self._overflow.append(item)
+            self._wake_one()
+            return
+        slot = slots[next(self._round_robin) % len(slots)]
+        slot.tasks.append(item)
+        if slot.closed:
+            self._drain(slot)
+        elif slot in self._sleepers:
+            self._sleepers.discard(slot)
+            slot.wakeup.set()
+        else:
+            self._wake_one()
+
+    def _wait_free_place(self, block: bool, timeout: float = None):
+        if not block:
+            raise Full
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.not_full:
+            self._put_waiters += 1
+            try:
+                while True:
+                    try:
+                        return self._free_places.pop()
+                    except IndexError:
+                        pass
+                    remain = None if end is None else end - time.monotonic()
+                    if remain is not None and remain <= 0:
+                        raise Full
+                    self.not_full.wait(remain)
+            finally:
+                self._put_waiters -= 1
+
+    def _release_place(self):
+        self._free_places.append(None)
+        # waiter counts itself before it takes a place, so it can not miss this notify
+        if self._put_waiters:
+            with self.not_full:
+                self.not_full.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def _take(self, slot: _WorkerSlot = None):
+        if slot is not None:
+            try:
+                return slot.tasks.popleft()
+            except IndexError:
+                pass
+        try:
+            return self._overflow.popleft()
+        except IndexError:
+            pass
+        slots = self._slots
+        start = next(self._round_robin)
+        for index in range(len(slots)):
+            other = slots[(start + index) % len(slots)]
+            if other is not slot:
+                try:
+                    return other.tasks.pop()
+                except IndexError:
+                    pass
+        return _NO_TASK
+
+    def _take_sentinel(self) -> bool:
+        with self._sentinels_mutex:
+            if self._sentinels:
+                self._sentinels -= 1
+                return True
+        return False
+
+    def get(self, block: bool = True, timeout: float = None, worker: "Worker" = None):
+        """
+            Get next task (own deque first, then steal) or None sentinel. without worker it never blocks
+        """
+        slot = None if worker is None else self._get_slot(worker)
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item = self._take(slot)
+            if item is _NO_TASK and slot is not None:
+                slot.wakeup.clear()
+                self._sleepers.add(slot)
+                item = self._take(slot)
+                if item is not _NO_TASK:
+                    self._sleepers.discard(slot)
+            if item is not _NO_TASK:
+                if self._free_places is not None:
+                    self._release_place()
+                return item
+            if self._take_sentinel():
+                if slot is not None:
+                    self._sleepers.discard(slot)
+                return None
+            if not block or slot is None:
+                raise Empty
+            remain = None if end is None else end - time.monotonic()
+            if remain is not None and remain <= 0:
+                self._sleepers.discard(slot)
+                raise Empty
+            slot.wakeup.wait(remain)
+            self._sleepers.discard(slot)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def pop_oldest(self):
+        """
+            Remove and return an old waiting task (head of the overflow or of the longest deque)
+        """
+        for tasks in [self._overflow] + sorted((slot.tasks for slot in self._slots), key=len, reverse=True):
+            try:
+                item = tasks.popleft()
+            except IndexError:
+                continue
+            if self._free_places is not None:
+                self._release_place()
+            return item
+        raise Empty
+
+    def task_done(self):
+        try:
+            self._unfinished.pop()
+        except IndexError:
+            raise ValueError("task_done() called too many times")
+        # joiner counts itself before it checks unfinished tasks, so it can not miss this notify
+        if not self._unfinished and self._joiners:
+            with self.all_tasks_done:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            self._joiners += 1
+            try:
+                while self._unfinished:
+                    self.all_tasks_done.wait()
+            finally:
+                self._joiners -= 1
+
+
+def as_completed(futures, timeout: float = None):
+    """
+        Yield futures as they finish
+    """
+    futures = list(futures)
+    finished = Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for _ in range(len(futures)):
+        remain = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            yield finished.get(timeout=remain)
+        except Empty:
+            raise TimeoutError(f"{len(futures)} futures are not finished")
+
+
+class TaskWatchdog(Thread):
+    """
+        One thread enforcing run timeout of all tasks of a pool (instead of a thread per task). when a task
+        times out, its future fails with FunctionTimedOut right away, but the task itself is not stopped:
+        nothing is raised inside the worker (an async exception can land while it holds a lock). the worker
+        is abandoned and replaced, so a blocked task can not hold the pool, until the pool has
+        max_abandoned_workers of them. the task can check task_timed_out() to return early
+    """
+
+    def __init__(self, pool: "ThreadPool"):
+        Thread.__init__(self, name=f"{pool.name} watchdog")
+        self.daemon = True
+        self.pool = pool
+        self._condition = Condition()
+        self._heap = []
+        self._stale = 0
+        self._sequence = count()
+        self._running = True
+        self._is_started = False
+
+    def watch(self, worker: "Worker", record: "TaskRecord") -> list:
+        """
+            Start watching task run by worker
+        """
+        entry = [time.perf_counter_ns() + int(record.timeout * 1e9), next(self._sequence), worker, record, True]
+        with self._condition:
+            if not self._is_started:
+                self._is_started = True
+                self.start()
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._condition.notify()
+        return entry
+
+    def unwatch(self, entry: list) -> bool:
+        """
+            Stop watching task. called by its worker. return False if task already timed out
+        """
+        with self._condition:
+            if entry[4]:
+                entry[2] = entry[3] = None
+                entry[4] = False
+                self._stale += 1
+                if self._stale > 1024 and self._stale * 2 > len(self._heap):
+                    self._heap = [item for item in self._heap if item[4]]
+                    heapq.heapify(self._heap)
+                    self._stale = 0
+                return True
+        return False
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._running:
+                        return
+                    while self._heap and not self._heap[0][4]:
+                        heapq.heappop(self._heap)
+                        self._stale -= 1
+                    now = time.perf_counter_ns()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._condition.wait(None if not self._heap else (self._heap[0][0] - now) / 1e9)
+                entry = heapq.heappop(self._heap)
+                _, _, worker, record, _ = entry
+                # decided before entry is closed, so worker sees it as soon as unwatch returns False
+                worker.abandoned = self.pool._abandon_worker(worker)
+                entry[4] = False
+            self.pool._task_timed_out(worker, record)
+
+
+_current_task = local()
+
+
+def task_timed_out() -> bool:
+    """
+        True if task running in current ThreadPool worker passed its timeout. timed out tasks are not
+        stopped, so long tasks can check it and return early
+    """
+    record = getattr(_current_task, "record", None)
+    return record is not None and record.status == "timeout"
+
+
+def _call_hook(pool_name: str, hook, record: TaskRecord):
+    try:
+        hook(record)
+    except Exception as e:
+        logger.exception(f"Error in hook of {pool_name} for task {record.id}. e: {e}")
+
+
 class Worker(Thread):
     """
         Thread executing tasks from a given tasks queue
@@ -25,8 +908,10 @@ class Worker(Thread):
         name = f"{pool.name} {index}"
         Thread.__init__(self, name=name)
         self.name = name
+        self.index = index
         self.pool = pool
         self.is_working = False
+        self.abandoned = False
         self.daemon = True
         self.start()
 
@@ -35,43 +920,82 @@ class Worker(Thread):
             Run
         """
         logger.info(f"Start worker {self.name}")
-        while self.pool.get_running():
+        while True:
             try:
-                task_detail, func, args, kwargs = self.pool.tasks.get(timeout=1)
+                task = self.pool.tasks.get(timeout=self.pool.idle_timeout if self.pool.autoscale else None,
+                                           worker=self)
             except Empty:
+                if self.pool._remove_idle_worker(self):
+                    break
+                continue
+            if task is None:
+                self.pool.tasks.task_done()
+                break
+            record, func, args, kwargs = task
+            timeout = record.timeout
+            record.start_ns = time.perf_counter_ns()
+            scale_up_wait_ns = self.pool.scale_up_wait_ns
+            if scale_up_wait_ns is not None and record.start_ns - record.insert_ns > scale_up_wait_ns:
+                self.pool._scale_up("queue wait")
+            if not record.future._set_running():
+                self.pool._finish_task(record, "cancelled", worker=self)
+                continue
+            if record.deadline_ns is not None and record.start_ns > record.deadline_ns:
+                logger.info(f"Task {record.id} passed its deadline in queue")
+                if record.drop_expired:
+                    record.future._finish("cancelled", exception=CancelledError())
+                    self.pool._finish_task(record, "dropped", worker=self)
+                else:
+                    self.pool._finish_task(record, "expired", exception=DeadlineExceeded(
+                        f"task {record.id} waited {(record.start_ns - record.insert_ns) / 1e9:.3f}s"), worker=self)
                 continue
-            task_id = task_detail["id"]
-            timeout = None
-            if type(func) == tuple:
-                func, timeout = func
-            task_detail["start_dt"] = datetime.now()
             self.is_working = True
+            if self.pool.on_task_start is not None:
+                _call_hook(self.pool.name, self.pool.on_task_start, record)
             if not callable(func):
-                task_detail["status"] = "not_run"
-                task_detail["end_dt"] = datetime.now()
-                logger.info(f"Task {task_id} is not callable in {self.name}")
+                logger.info(f"Task {record.id} is not callable in {self.name}")
+                self.pool._finish_task(record, "not_run", exception=TypeError(f"task {record.id} is not callable"),
+                                       worker=self)
+                self.is_working = False
                 continue
+            status = "error"
+            result = None
+            exception = None
+            timed_out = False
             try:
-                task_detail["status"] = "running"
-                logger.debug(f"Start running function {func.__name__} in {self.name}.")
-                result = func_timeout(timeout, func=func, args=args, kwargs=kwargs)
-                task_detail["status"] = "done"
-                task_detail["result"] = result
-            except FunctionTimedOut:
-                logger.error(
-                    f"Timeout in function {func.__name__} in task {task_id} thread {self.name} after {timeout}")
-                task_detail["status"] = "timeout"
+                record.status = "running"
+                logger.debug(f"Start running function {record.name} in {self.name}.")
+                if timeout is None:
+                    result = func(*args, **kwargs)
+                else:
+                    entry = self.pool.watchdog.watch(self, record)
+                    _current_task.record = record
+                    try:
+                        result = func(*args, **kwargs)
+                    finally:
+                        _current_task.record = None
+                        timed_out = not self.pool.watchdog.unwatch(entry)
+                status = "done"
+            except FunctionTimedOut as e:
+                if not timed_out:
+                    logger.error(f"Timeout in function {record.name} in task {record.id} thread {self.name}")
+                    status = "timeout"
+                    exception = e
             except Exception as e:
-                logger.exception(f"Error in function {func.__name__} in task {task_id} thread {self.name}. e: {e}")
-                task_detail["status"] = "error"
+                if not timed_out:
+                    logger.exception(
+                        f"Error in function {record.name} in task {record.id} thread {self.name}. e: {e}")
+                    exception = e
             finally:
-                self.pool.tasks.task_done()
-                logger.debug(f"Finish running function {func.__name__} in thread {self.name}.")
-                task_detail["end_dt"] = datetime.now()
-                duration = task_detail["end_dt"] - task_detail["insert_dt"]
-                if self.pool.log_detail:
-                    logger.info(f"Task {task_id} Complete in {self.name} in {duration}")
+                if not timed_out:
+                    logger.debug(f"Finish running function {record.name} in thread {self.name}.")
+                    self.pool._finish_task(record, status, result, exception, worker=self)
+            if timed_out and self.abandoned:
+                self.pool._abandoned_worker_done(self)
+                logger.info(f"Worker {self.name} left the pool after timeout of task {record.id}")
+                return
             self.is_working = False
+        self.pool.tasks.unregister(self)
         logger.info(f"Terminate worker {self.name}")
 
 
@@ -81,13 +1005,72 @@ class ThreadPool:
     """
 
     def __init__(self, worker_count: int = 4, total_queue: int = 20, *, name: str = __name__,
-                 save_detail: bool = False, log_detail: bool = False):
-        self.tasks = Queue(total_queue)
+                 save_detail: bool = False, log_detail: bool = False, return_future: bool = False,
+                 history_size: int = 1000, history_age: float = None, max_worker_count: int = None,
+                 scale_up_queue_size: int = None, scale_up_wait: float = None, idle_timeout: float = 60,
+                 scheduler: str = "shared", reject_policy: str = "block", put_timeout: float = None,
+                 on_task_start=None, on_task_finish=None, max_abandoned_workers: int = None):
+        """
+
+        Args:
+            worker_count (int): number of worker threads (min number if max_worker_count is set)
+            total_queue (int): max pending tasks. add_task blocks when queue is full.
+                tasks are run by priority inside their group, and groups take turns (see TaskOptions)
+            name (str): name of pool
+            save_detail (bool): keep TaskRecord of tasks in tasks_data
+            log_detail (bool): log every task completion
+            return_future (bool): add_task returns TaskFuture instead of task id
+            history_size (int): max records kept in tasks_data. oldest are evicted first
+            history_age (float): evict records older than this seconds
+            max_worker_count (int): enable autoscaling up to this number of workers
+            scale_up_queue_size (int): add a worker when this many tasks are waiting (default worker_count)
+            scale_up_wait (float): add a worker when a task waited this seconds in queue
+            idle_timeout (float): remove a worker (above worker_count) idle for this seconds
+            scheduler (str): "shared" queue with priorities and groups, or "stealing" per worker deques with
+                work stealing (less lock contention with many workers and tiny tasks)
+            reject_policy (str): what add_task does when queue is full. "block" (until put_timeout, then raise),
+                "raise" TaskRejected, "drop_oldest" waiting task, "drop_newest" (the new task), "caller_runs" (run
+                new task in caller thread)
+            put_timeout (float): max seconds add_task blocks with "block" policy
+            on_task_start: called with TaskRecord in worker thread before task runs (e.g. to start a trace span)
+            on_task_finish: called with TaskRecord after task is finished, rejected or cancelled (status is set)
+            max_abandoned_workers (int): timed out tasks are not stopped. their worker is replaced while fewer
+                than this many (default max worker count) still run timed out tasks. past it, the worker is kept
+                and goes back to work when its task returns
+        """
+        if reject_policy not in ("block", "raise", "drop_oldest", "drop_newest", "caller_runs"):
+            raise ValueError(f"unknown reject policy {reject_policy}")
+        self.reject_policy = reject_policy
+        self.put_timeout = put_timeout
+        self.on_task_start = on_task_start
+        self.on_task_finish = on_task_finish
+        if scheduler == "stealing":
+            self.tasks = StealingTaskQueue(total_queue)
+        elif scheduler == "shared":
+            self.tasks = TaskQueue(total_queue)
+        else:
+            raise ValueError(f"unknown scheduler {scheduler}")
         self.name = name
-        self.tasks_data = {}
+        self.tasks_data = OrderedDict()
+        self.history_size = history_size
+        self.history_age = history_age
+        self.stats = PoolStats()
+        self._task_ids = count(1)
+        self.watchdog = TaskWatchdog(self)
+        self.workers_mutex = Lock()
         self.save_detail = save_detail
         self.log_detail = log_detail
+        self.return_future = return_future
         self.tasks_mutex = Lock()
+        self.worker_count = worker_count
+        self.max_worker_count = max(max_worker_count or worker_count, worker_count)
+        self.autoscale = self.max_worker_count > worker_count
+        self.scale_up_queue_size = worker_count if scale_up_queue_size is None else scale_up_queue_size
+        self.scale_up_wait_ns = None if scale_up_wait is None or not self.autoscale else int(scale_up_wait * 1e9)
+        self.idle_timeout = idle_timeout
+        self._worker_ids = count(worker_count)
+        self.max_abandoned_workers = self.max_worker_count if max_abandoned_workers is None else max_abandoned_workers
+        self._abandoned_workers = set()
         logger.info(f"{self.name} Create {worker_count} Worker With MAX_QUEUE: {total_queue}")
         self.workers = []
         self._running = True
@@ -101,21 +1084,239 @@ class ThreadPool:
         if not self._running:
             raise Exception("the threadpool stopped")
 
-    def add_task(self, func, *args, **kargs) -> int:
-        """Add a task to the queue"""
+    def add_task(self, func, *args, **kargs):
+        """
+            Add a task to the queue. return task id (or TaskFuture if return_future is set).
+            func can be a TaskOptions (or a (func, timeout) tuple) to set scheduling options.
+            when queue is full, reject_policy of pool decides
+        """
+        future = self._put_task(func, args, kargs)
+        if self.return_future:
+            return future
+        return future.task_id
+
+    def try_add_task(self, func, *args, **kargs):
+        """
+            Like add_task but never block. return None if queue is full
+        """
+        future = self._put_task(func, args, kargs, block=False)
+        if future is None:
+            return None
+        if self.return_future:
+            return future
+        return future.task_id
+
+    def submit(self, func, *args, **kargs) -> TaskFuture:
+        """Add a task to the queue and return its TaskFuture"""
+        return self._put_task(func, args, kargs)
+
+    def _put_task(self, func, args, kargs, block: bool = True) -> TaskFuture:
         self._check_running()
-        with self.tasks_mutex:
-            task_id = len(self.tasks_data.keys()) + 1
-            task_detail = {
-                "id": task_id,
-                "status": "pending",
-                "insert_dt": datetime.now()
-            }
-            if self.save_detail:
-                self.tasks_data[task_id] = task_detail
+        # next() of itertools.count is atomic, so ids need no lock
+        task_id = next(self._task_ids)
+        future = TaskFuture(task_id)
+        if type(func) == tuple:
+            func, timeout = func
+            func = TaskOptions(func, timeout=timeout)
+        if isinstance(func, TaskOptions):
+            record = TaskRecord(task_id, future, func, _task_name(func.func))
+            func = func.func
+        else:
+            record = TaskRecord(task_id, future, name=_task_name(func))
+        if self.save_detail:
+            with self.tasks_mutex:
+                self.tasks_data[task_id] = record
+                self._evict_history()
+        task = (record, func, args, kargs)
+        if not block:
+            try:
+                self.tasks.put(task, block=False)
+            except Full:
+                self._finish_task(record, "rejected", exception=TaskRejected(f"task {task_id} queue is full"),
+                                  queued=False)
+                return None
+        elif not self._put_full(task):
+            return future
+        if not self._running and future.cancel():
+            raise Exception("the threadpool stopped")
+        if self.autoscale and self.tasks.qsize() >= self.scale_up_queue_size:
+            self._scale_up("queue size")
+        return future
+
+    def _put_full(self, task: tuple) -> bool:
+        """
+            Put task by reject_policy. return False if task is not queued (dropped or run by caller)
+        """
+        record = task[0]
+        policy = self.reject_policy
+        if policy == "block":
+            try:
+                self.tasks.put(task, timeout=self.put_timeout)
+                return True
+            except Full:
+                policy = "raise"
+        elif policy == "drop_oldest":
+            while True:
+                try:
+                    self.tasks.put(task, block=False)
+                    return True
+                except Full:
+                    pass
+                try:
+                    oldest = self.tasks.pop_oldest()[0]
+                except Empty:
+                    continue
+                logger.warning(f"{self.name} queue is full. drop task {oldest.id}")
+                self._finish_task(oldest, "rejected", exception=TaskRejected(f"task {oldest.id} is dropped"))
+        else:
+            try:
+                self.tasks.put(task, block=False)
+                return True
+            except Full:
+                pass
+        if policy == "caller_runs":
+            self._run_in_caller(*task)
+            return False
+        self._finish_task(record, "rejected", exception=TaskRejected(f"task {record.id} queue is full"),
+                          queued=False)
+        if policy == "drop_newest":
+            logger.warning(f"{self.name} queue is full. drop task {record.id}")
+            return False
+        raise TaskRejected(f"{self.name} queue is full")
+
+    def _run_in_caller(self, record: TaskRecord, func, args, kargs):
+        """
+            Run task in caller thread (caller_runs policy). timeout of task is not enforced here
+        """
+        record.start_ns = time.perf_counter_ns()
+        if not record.future._set_running():
+            self._finish_task(record, "cancelled", queued=False)
+            return
+        if self.on_task_start is not None:
+            _call_hook(self.name, self.on_task_start, record)
+        result = None
+        exception = None
+        status = "error"
+        try:
+            if not callable(func):
+                status = "not_run"
+                raise TypeError(f"task {record.id} is not callable")
+            result = func(*args, **kargs)
+            status = "done"
+        except Exception as e:
+            logger.exception(f"Error in task {record.id} run by caller. e: {e}")
+            exception = e
+        finally:
+            self._finish_task(record, status, result, exception, queued=False)
+
+    def _scale_up(self, reason: str):
+        with self.workers_mutex:
+            if not self._running or len(self.workers) >= self.max_worker_count:
+                return
+            self.workers.append(Worker(self, index=next(self._worker_ids)))
+            worker_count = len(self.workers)
+        self.stats.add_event("scale_up")
+        logger.info(f"{self.name} scale up to {worker_count} workers by {reason}")
+
+    def _remove_idle_worker(self, worker: Worker) -> bool:
+        """
+            Remove idle worker if pool has more than worker_count workers. return True if removed
+        """
+        with self.workers_mutex:
+            if self._running and len(self.workers) <= self.worker_count:
+                return False
+            if worker in self.workers:
+                self.workers.remove(worker)
+            worker_count = len(self.workers)
+        if self._running:
+            self.stats.add_event("scale_down")
+            logger.info(f"{self.name} scale down to {worker_count} workers")
+        return True
+
+    def _evict_history(self):
+        while len(self.tasks_data) > self.history_size:
+            self.tasks_data.popitem(last=False)
+        if self.history_age is not None:
+            oldest_ns = time.perf_counter_ns() - int(self.history_age * 1e9)
+            while self.tasks_data and next(iter(self.tasks_data.values())).insert_ns < oldest_ns:
+                self.tasks_data.popitem(last=False)
+
+    def _finish_task(self, record: TaskRecord, status: str, result=None, exception: BaseException = None,
+                     worker: Worker = None, queued: bool = True):
+        """
+            Save end of task in record, stats and future
+        """
+        record.end_ns = time.perf_counter_ns()
+        record.status = status
+        if self.save_detail:
+            record.result = result
+        self.stats.add(record)
+        if self.log_detail:
+            duration = (record.end_ns - record.insert_ns) / 1e9
+            logger.info(f"Task {record.id} Complete in {worker.name if worker else self.name} in {duration:.6f}s")
+        if status not in ("cancelled", "dropped"):
+            record.future._set_result(result, exception)
+        if self.on_task_finish is not None:
+            _call_hook(self.name, self.on_task_finish, record)
+        if queued:
+            self.tasks.task_done()
+
+    def _abandon_worker(self, worker: Worker) -> bool:
+        """
+            Called by watchdog. return True if worker of a timed out task can be replaced
+        """
+        with self.workers_mutex:
+            if len(self._abandoned_workers) >= self.max_abandoned_workers:
+                return False
+            self._abandoned_workers.add(worker)
+            return True
 
-            self.tasks.put((task_detail, func, args, kargs))
-        return task_id
+    def _abandoned_worker_done(self, worker: Worker):
+        with self.workers_mutex:
+            self._abandoned_workers.discard(worker)
+
+    def _task_timed_out(self, worker: Worker, record: TaskRecord):
+        """
+            Called by watchdog. finish task and replace its worker if it is abandoned (it may still be blocked in task)
+        """
+        logger.error(f"Timeout in task {record.id} thread {worker.name} after {record.timeout}")
+        if worker.abandoned:
+            worker.is_working = False
+            self.tasks.unregister(worker)
+            with self.workers_mutex:
+                self.workers[self.workers.index(worker)] = Worker(self, index=worker.index)
+        else:
+            logger.error(f"{self.name} has {len(self._abandoned_workers)} abandoned workers. "
+                         f"worker {worker.name} is not replaced and waits for its task")
+        self._finish_task(record, "timeout", exception=FunctionTimedOut(
+            f"task {record.id} timed out after {record.timeout} seconds", record.timeout), worker=worker)
+
+    def map(self, func, *iterables, timeout: float = None, max_in_flight: int = None):
+        """
+            Like builtin map but run func in pool. yield results in order. only max_in_flight tasks
+            (default twice worker count) are submitted ahead of the consumer
+        """
+        if max_in_flight is None:
+            max_in_flight = len(self.workers) * 2
+        arguments = zip(*iterables)
+        in_flight = deque(self.submit(func, *args) for args in islice(arguments, max(max_in_flight, 1)))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while in_flight:
+                future = in_flight.popleft()
+                for args in islice(arguments, 1):
+                    in_flight.append(self.submit(func, *args))
+                yield future.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    @staticmethod
+    def as_completed(futures, timeout: float = None):
+        """
+            Yield futures as they finish
+        """
+        return as_completed(futures, timeout)
 
     def wait_completion(self, terminate: bool = False):
         """
@@ -124,68 +1325,788 @@ class ThreadPool:
         self._check_running()
         self.tasks.join()
         if terminate:
+            self.shutdown(wait=False)
+
+    def shutdown(self, wait: bool = True, cancel_pending: bool = False):
+        """
+            Stop accepting tasks and stop workers after queued tasks are done
+        Args:
+            wait (bool): wait for workers to finish
+            cancel_pending (bool): cancel tasks which are not started yet instead of running them
+        """
+        with self.tasks_mutex:
+            stopping = self._running
             self._running = False
+        if stopping:
+            logger.info(f"{self.name} shutdown")
+            if cancel_pending:
+                self._cancel_pending()
+            with self.workers_mutex:
+                worker_count = len(self.workers)
+            for _ in range(worker_count):
+                self.tasks.put(None)
+        if wait:
+            joined = set()
+            while True:
+                with self.workers_mutex:
+                    workers = [worker for worker in self.workers if worker not in joined]
+                if not workers:
+                    break
+                for worker in workers:
+                    worker.join()
+                    joined.add(worker)
+            self.watchdog.stop()
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except Empty:
+                return
+            if task is None:
+                self.tasks.task_done()
+                continue
+            record = task[0]
+            record.future.cancel()
+            self._finish_task(record, "cancelled")
 
-    def get_task_data(self, task_id: int) -> dict:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+
+    def get_task_data(self, task_id: int) -> TaskRecord:
         """
             Get task data
         """
         return self.tasks_data.get(task_id)
 
+    def get_stats(self) -> dict:
+        """
+            Counters and duration histograms of finished tasks, scaling events and current worker count
+        """
+        stats = self.stats.to_dict()
+        stats["workers"] = len(self.workers)
+        return stats
+
+    def get_metrics(self, previous: dict = None) -> dict:
+        """
+            Snapshot for metric collectors: get_stats with queue depth, active workers, counters and histograms by
+            function name, finished tasks counter with its time.monotonic timestamp, and tasks per second since
+            previous snapshot of the same collector (or since pool creation)
+        """
+        metrics = self.stats.to_dict(functions=True)
+        workers = list(self.workers)
+        metrics["workers"] = len(workers)
+        metrics["active_workers"] = sum(1 for worker in workers if worker.is_working)
+        metrics["queue_depth"] = self.tasks.qsize()
+        metrics["tasks_per_second"] = self.stats.tasks_per_second(metrics, previous)
+        return metrics
+
     def get_free_worker(self):
         """
             for get number of free worker
         """
         free_worker = 0
-        for worker in self.workers:
+        for worker in list(self.workers):
             if not worker.is_working:
                 free_worker += 1
         return free_worker
 
 
+class AsyncPool:
+    """
+        Pool with the interface of ThreadPool that runs tasks on an asyncio event loop in a background thread.
+        coroutine functions (and coroutine objects) run on the loop and at most worker_count of them run at the
+        same time, so one thread can serve thousands of concurrent I/O tasks. sync functions are sent to a thread
+        executor and count as a running task too. a sync function can not be stopped on timeout, so its task is
+        finished as timeout but its slot is kept until the function returns
+    """
+
+    def __init__(self, worker_count: int = 100, total_queue: int = 1000, *, name: str = __name__,
+                 save_detail: bool = False, log_detail: bool = False, return_future: bool = False,
+                 history_size: int = 1000, history_age: float = None, executor_workers: int = None,
+                 on_task_start=None, on_task_finish=None):
+        """
+
+        Args:
+            worker_count (int): max tasks running at the same time
+            total_queue (int): max tasks waiting to start. add_task blocks when it is full (except in loop thread)
+            name (str): name of pool
+            save_detail (bool): keep TaskRecord of tasks in tasks_data
+            log_detail (bool): log every task completion
+            return_future (bool): add_task returns TaskFuture instead of task id
+            history_size (int): max records kept in tasks_data. oldest are evicted first
+            history_age (float): evict records older than this seconds
+            executor_workers (int): threads of executor for sync functions (default of ThreadPoolExecutor)
+            on_task_start: called with TaskRecord in loop thread before task runs
+            on_task_finish: called with TaskRecord after task is finished, rejected or cancelled (status is set)
+        """
+        self.name = name
+        self.worker_count = worker_count
+        self.total_queue = total_queue
+        self.save_detail = save_detail
+        self.log_detail = log_detail
+        self.return_future = return_future
+        self.history_size = history_size
+        self.history_age = history_age
+        self.on_task_start = on_task_start
+        self.on_task_finish = on_task_finish
+        self.tasks_data = OrderedDict()
+        self.tasks_mutex = Lock()
+        self.stats = PoolStats()
+        self._task_ids = count(1)
+        self._pending = {}
+        # loop keeps only weak references of tasks
+        self._tasks = set()
+        self._unfinished = 0
+        self._active = 0
+        self._condition = Condition(self.tasks_mutex)
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix=f"{name} executor")
+        # asyncio is imported by the first AsyncPool only, it is slow to import
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._running = True
+        started = Event()
+        self._thread = Thread(target=self._run_loop, args=(started,), name=f"{name} loop", daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.info(f"{self.name} Create async pool with {worker_count} concurrent tasks and MAX_QUEUE: {total_queue}")
+
+    def _run_loop(self, started: Event):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        # semaphore is made in loop thread to bind it to this loop
+        self._semaphore = asyncio.Semaphore(self.worker_count)
+        self.loop.call_soon(started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def get_running(self):
+        return self._running
+
+    def _check_running(self):
+        if not self._running:
+            raise Exception("the asyncpool stopped")
+
+    def add_task(self, func, *args, **kargs):
+        """
+            Add a task. func is a coroutine function, a coroutine object or a sync function.
+            return task id (or TaskFuture if return_future is set).
+            func can be a TaskOptions (or a (func, timeout) tuple) to set timeout and deadline
+        """
+        future = self._put_task(func, args, kargs)
+        if self.return_future:
+            return future
+        return future.task_id
+
+    def try_add_task(self, func, *args, **kargs):
+        """
+            Like add_task but never block. return None if queue is full
+        """
+        future = self._put_task(func, args, kargs, block=False)
+        if future is None:
+            return None
+        if self.return_future:
+            return future
+        return future.task_id
+
+    def submit(self, func, *args, **kargs) -> TaskFuture:
+        """Add a task and return its TaskFuture"""
+        return self._put_task(func, args, kargs)
+
+    def _put_task(self, func, args, kargs, block: bool = True) -> TaskFuture:
+        self._check_running()
+        task_id = next(self._task_ids)
+        future = TaskFuture(task_id)
+        if type(func) == tuple:
+            func, timeout = func
+            func = TaskOptions(func, timeout=timeout)
+        if isinstance(func, TaskOptions):
+            record = TaskRecord(task_id, future, func, _task_name(func.func))
+            func = func.func
+        else:
+            record = TaskRecord(task_id, future, name=_task_name(func))
+        limit = self.worker_count + self.total_queue
+        with self._condition:
+            if self._unfinished >= limit:
+                if not block:
+                    record.end_ns = time.perf_counter_ns()
+                    record.status = "rejected"
+                    self.stats.add(record)
+                    future._set_result(exception=TaskRejected(f"task {task_id} queue is full"))
+                    if self.on_task_finish is not None:
+                        _call_hook(self.name, self.on_task_finish, record)
+                    return None
+                # waiting in loop thread would stop the loop that frees the queue
+                if get_ident() != self._thread.ident:
+                    self._condition.wait_for(lambda: self._unfinished < limit or not self._running)
+            self._check_running()
+            self._unfinished += 1
+            self._pending[task_id] = record
+            if self.save_detail:
+                self.tasks_data[task_id] = record
+                self._evict_history()
+        self.loop.call_soon_threadsafe(self._start_task, record, func, args, kargs)
+        return future
+
+    def _start_task(self, record: TaskRecord, func, args, kargs):
+        task = self.loop.create_task(self._run_task(record, func, args, kargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_task(self, record: TaskRecord, func, args, kargs):
+        import asyncio
+        await self._semaphore.acquire()
+        executor_future = None
+        started = False
+        try:
+            with self.tasks_mutex:
+                self._pending.pop(record.id, None)
+            record.start_ns = time.perf_counter_ns()
+            if not record.future._set_running():
+                if asyncio.iscoroutine(func):
+                    func.close()
+                self._finish_task(record, "cancelled")
+                return
+            if record.deadline_ns is not None and record.start_ns > record.deadline_ns:
+                logger.info(f"Task {record.id} passed its deadline in queue")
+                if asyncio.iscoroutine(func):
+                    func.close()
+                if record.drop_expired:
+                    record.future._finish("cancelled", exception=CancelledError())
+                    self._finish_task(record, "dropped")
+                else:
+                    self._finish_task(record, "expired", exception=DeadlineExceeded(
+                        f"task {record.id} waited {(record.start_ns - record.insert_ns) / 1e9:.3f}s"))
+                return
+            if asyncio.iscoroutine(func):
+                awaitable = func
+            elif not callable(func):
+                logger.info(f"Task {record.id} is not callable in {self.name}")
+                self._finish_task(record, "not_run", exception=TypeError(f"task {record.id} is not callable"))
+                return
+            elif asyncio.iscoroutinefunction(func):
+                awaitable = func(*args, **kargs)
+            else:
+                executor_future = self.executor.submit(func, *args, **kargs)
+                awaitable = asyncio.wrap_future(executor_future, loop=self.loop)
+            self._active += 1
+            started = True
+            record.status = "running"
+            if self.on_task_start is not None:
+                _call_hook(self.name, self.on_task_start, record)
+            status = "error"
+            result = None
+            exception = None
+            try:
+                if record.timeout is None:
+                    result = await awaitable
+                else:
+                    result = await asyncio.wait_for(awaitable, record.timeout)
+                status = "done"
+            except asyncio.TimeoutError:
+                logger.error(f"Timeout in task {record.id} of {self.name} after {record.timeout}")
+                status = "timeout"
+                exception = FunctionTimedOut(f"task {record.id} timed out after {record.timeout} seconds",
+                                             record.timeout)
+            except Exception as e:
+                logger.exception(f"Error in task {record.id} of {self.name}. e: {e}")
+                exception = e
+            except BaseException as e:
+                # CancelledError or GeneratorExit of a destroyed task. fail future instead of a None result
+                logger.error(f"Task {record.id} of {self.name} stopped by {type(e).__name__}")
+                exception = e
+                raise
+            finally:
+                self._finish_task(record, status, result, exception)
+        finally:
+            if executor_future is not None and not executor_future.done():
+                # sync function can not be stopped on timeout. keep its slot until its thread is free
+                executor_future.add_done_callback(self._release_executor_slot)
+            else:
+                self._release_slot(started)
+
+    def _release_slot(self, started: bool = True):
+        if started:
+            self._active -= 1
+        self._semaphore.release()
+
+    def _release_executor_slot(self, _future):
+        """
+            Done callback of a sync function that outlived its timeout. called in executor thread
+        """
+        try:
+            self.loop.call_soon_threadsafe(self._release_slot)
+        except RuntimeError:
+            # loop is closed by shutdown
+            pass
+
+    def _finish_task(self, record: TaskRecord, status: str, result=None, exception: BaseException = None):
+        """
+            Save end of task in record, stats and future
+        """
+        record.end_ns = time.perf_counter_ns()
+        record.status = status
+        if self.save_detail:
+            record.result = result
+        self.stats.add(record)
+        if self.log_detail:
+            logger.info(f"Task {record.id} Complete in {self.name} in {(record.end_ns - record.insert_ns) / 1e9:.6f}s")
+        if status not in ("cancelled", "dropped"):
+            record.future._set_result(result, exception)
+        if self.on_task_finish is not None:
+            _call_hook(self.name, self.on_task_finish, record)
+        with self._condition:
+            self._unfinished -= 1
+            if self._unfinished == 0 and not self._running:
+                self.loop.stop()
+            self._condition.notify_all()
+
+    def wait_completion(self, terminate: bool = False):
+        """
+            Wait for completion of all the tasks. must not be called in loop thread
+        """
+        self._check_running()
+        with self._condition:
+            self._condition.wait_for(lambda: self._unfinished == 0)
+        if terminate:
+            self.shutdown(wait=False)
+
+    def shutdown(self, wait: bool = True, cancel_pending: bool = False):
+        """
+            Stop accepting tasks and stop event loop after added tasks are done
+        Args:
+            wait (bool): wait for tasks and loop thread to finish
+            cancel_pending (bool): cancel tasks which are not started yet instead of running them
+        """
+        with self._condition:
+            stopping = self._running
+            self._running = False
+            pending = list(self._pending.values())
+            if stopping and self._unfinished == 0:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+            self._condition.notify_all()
+        if stopping:
+            logger.info(f"{self.name} shutdown")
+            if cancel_pending:
+                for record in pending:
+                    record.future.cancel()
+        if wait and get_ident() != self._thread.ident:
+            self._thread.join()
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+
+    def _evict_history(self):
+        while len(self.tasks_data) > self.history_size:
+            self.tasks_data.popitem(last=False)
+        if self.history_age is not None:
+            oldest_ns = time.perf_counter_ns() - int(self.history_age * 1e9)
+            while self.tasks_data and next(iter(self.tasks_data.values())).insert_ns < oldest_ns:
+                self.tasks_data.popitem(last=False)
+
+    def get_task_data(self, task_id: int) -> TaskRecord:
+        """
+            Get task data
+        """
+        return self.tasks_data.get(task_id)
+
+    def get_stats(self) -> dict:
+        """
+            Counters and duration histograms of finished tasks and number of running tasks
+        """
+        stats = self.stats.to_dict()
+        stats["running"] = self._active
+        return stats
+
+    def get_metrics(self, previous: dict = None) -> dict:
+        """
+            Snapshot for metric collectors: get_stats with queue depth, counters and histograms by function name,
+            finished tasks counter with its time.monotonic timestamp, and tasks per second since previous snapshot
+            of the same collector (or since pool creation)
+        """
+        metrics = self.stats.to_dict(functions=True)
+        active = self._active
+        metrics["running"] = active
+        metrics["queue_depth"] = max(self._unfinished - active, 0)
+        metrics["tasks_per_second"] = self.stats.tasks_per_second(metrics, previous)
+        return metrics
+
+    def get_free_worker(self):
+        """
+            for get number of free slots for running tasks
+        """
+        return self.worker_count - self._active
+
+
+def _picklable_exception(exception: BaseException) -> BaseException:
+    try:
+        pickle.dumps(exception)
+        return exception
+    except Exception:
+        return RuntimeError(f"{type(exception).__name__}: {exception}")
+
+
+def _run_chunk(handler, max_thread: int, chunk: list) -> list:
+    """
+        Run handler on items of chunk in threads. return (True, result) or (False, exception) for every item
+    """
+    if not chunk:
+        return []
+    outputs = []
+    with ThreadPoolExecutor(max_workers=max(min(len(chunk), max_thread), 1)) as executor:
+        for future in [executor.submit(handler, item) for item in chunk]:
+            try:
+                outputs.append((True, future.result()))
+            except Exception as e:
+                logger.exception(f"Error in handler. e: {e}")
+                outputs.append((False, _picklable_exception(e)))
+    return outputs
+
+
+class _SharedRef:
+    """
+        Place of a buffer (bytes like or numpy array) in a shared memory block
+    """
+    __slots__ = ("offset", "size", "dtype", "shape")
+
+    def __init__(self, offset: int, size: int, dtype: str = None, shape: tuple = None):
+        self.offset = offset
+        self.size = size
+        self.dtype = dtype
+        self.shape = shape
+
+
+def _shared_buffer(value, min_size: int):
+    """
+        return (flat byte memoryview, dtype, shape) of value if it should go to shared memory, else None
+    """
+    # an array can only be passed if numpy is already imported, so importing it here is never needed
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if value.dtype.hasobject or value.nbytes < min_size:
+            return None
+        value = numpy.ascontiguousarray(value)
+        return memoryview(value).cast("B"), value.dtype.str, value.shape
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        view = memoryview(value)
+        if view.nbytes < min_size:
+            return None
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        return view.cast("B"), None, None
+    return None
+
+
+def _pack_shared(values: list, min_size: int):
+    """
+        Copy big buffers of values to one shared memory block and put _SharedRef in place of them
+    Returns:
+        (block or None, values)
+    """
+    buffers = {}
+    total = 0
+    for position, value in enumerate(values):
+        buffer = _shared_buffer(value, min_size)
+        if buffer is not None:
+            buffers[position] = buffer
+            total += buffer[0].nbytes
+    if not buffers:
+        return None, values
+    block = shared_memory.SharedMemory(create=True, size=total)
+    values = list(values)
+    offset = 0
+    for position, (view, dtype, shape) in buffers.items():
+        block.buf[offset:offset + view.nbytes] = view
+        values[position] = _SharedRef(offset, view.nbytes, dtype, shape)
+        offset += view.nbytes
+    return block, values
+
+
+def _shared_view(block, ref: _SharedRef):
+    """
+        Zero copy and read only view of ref in block
+    """
+    if ref.dtype is not None:
+        import numpy
+        view = numpy.ndarray(ref.shape, dtype=ref.dtype, buffer=block.buf, offset=ref.offset)
+        view.flags.writeable = False
+        return view
+    return block.buf[ref.offset:ref.offset + ref.size].toreadonly()
+
+
+def _close_shared(block, unlink: bool = False):
+    try:
+        block.close()
+    except BufferError:
+        # a view is still used by handler. memory is released with the process
+        pass
+    if unlink:
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _run_shared_chunk(handler, max_thread: int, name: str, chunk: list, min_size: int):
+    """
+        Run chunk that its big inputs are in shared memory block name. big outputs are sent back in a new block
+    Returns:
+        (output block name or None, outputs)
+    """
+    block = shared_memory.SharedMemory(name=name) if name else None
+    if block is not None:
+        chunk = [_shared_view(block, item) if isinstance(item, _SharedRef) else item for item in chunk]
+    outputs = _run_chunk(handler, max_thread, chunk)
+    del chunk
+    results = [value if success else None for success, value in outputs]
+    results = [bytes(value) if isinstance(value, memoryview) and value.nbytes < min_size else value
+               for value in results]
+    result_block, results = _pack_shared(results, min_size)
+    outputs = [(success, result if success else value) for (success, value), result in zip(outputs, results)]
+    if block is not None:
+        _close_shared(block)
+    if result_block is None:
+        return None, outputs
+    result_block.close()
+    return result_block.name, outputs
+
+
+def _unpack_shared(name: str, outputs: list) -> list:
+    """
+        Copy outputs of _run_shared_chunk from shared memory and free the block
+    """
+    if name is None:
+        return outputs
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        unpacked = []
+        for success, value in outputs:
+            if isinstance(value, _SharedRef):
+                view = _shared_view(block, value)
+                value = view.copy() if value.dtype is not None else bytes(view)
+                del view
+            unpacked.append((success, value))
+        return unpacked
+    finally:
+        _close_shared(block, unlink=True)
+
+
 class ProcessThreadPool:
     """
         Combine Process and thread
     """
 
-    def __init__(self, max_process: int = 8, max_thread: int = 20):
+    def __init__(self, max_process: int = 8, max_thread: int = 20, *, initializer=None, initargs: tuple = (),
+                 maxtasksperchild: int = None):
+        """
+            process pool is made on first run and reused by next runs until close
+        Args:
+            max_process (int): number of processes
+            max_thread (int): max threads in each process
+            initializer: called with initargs once in each process when it starts (e.g. open db connections)
+            maxtasksperchild (int): replace a process after this many chunks. None keeps processes forever
+        """
         self.max_process = max_process
         self.max_thread = max_thread
+        self.initializer = initializer
+        self.initargs = initargs
+        self.maxtasksperchild = maxtasksperchild
         self.handler = None
+        self._pool = None
+        self._pool_shares_tracker = False
+        self._pool_mutex = Lock()
+
+    def _get_pool(self, use_shared_memory: bool = False):
+        with self._pool_mutex:
+            track = use_shared_memory and os.name == "posix"
+            if track and self._pool is not None and not self._pool_shares_tracker:
+                # processes forked before resource tracker started have their own trackers. replace them by a new
+                # pool. sent chunks still finish in old one
+                self._pool.close()
+                self._pool = None
+            if self._pool is None:
+                if track:
+                    # processes must share tracker of parent, else each one unlinks shared memories it saw on exit
+                    from multiprocessing import resource_tracker
+                    resource_tracker.ensure_running()
+                self._pool_shares_tracker = track
+                self._pool = multiprocessing.Pool(self.max_process, initializer=self.initializer,
+                                                  initargs=self.initargs, maxtasksperchild=self.maxtasksperchild)
+                logger.info(f"start make {self.max_process} process")
+            return self._pool
 
-    def process_run(self, iterable: list, handler, job_per_process: int = None):
+    def close(self, wait: bool = True):
         """
-            for run process
+            Stop processes. with wait, let sent chunks finish, otherwise terminate them
+        """
+        with self._pool_mutex:
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        if wait:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def process_run(self, iterable, handler, job_per_process: int = None, **kwargs) -> list:
+        """
+            for run process. return results in order of iterable (exception object for failed items).
+            kwargs are passed to process_iter
         """
         if not callable(handler):
             return
+        return list(self.process_iter(iterable, handler, job_per_process, return_exceptions=True, **kwargs))
+
+    def process_iter(self, iterable, handler, job_per_process: int = None, *, ordered: bool = True,
+                     return_exceptions: bool = False, max_in_flight: int = None, use_shared_memory: bool = False,
+                     shared_min_size: int = 1 << 16, chunking: str = "guided", min_chunk_size: int = 1):
+        """
+            Run handler on items of iterable (any iterable or generator) in processes and threads and yield
+            results. chunks are read from iterable lazily. calls from several threads share the process pool; if
+            consumer stops early (or an item raises), its sent chunks still run and their results are dropped
+        Args:
+            iterable: input items
+            handler: picklable function of one item
+            job_per_process (int): items in each chunk sent to a process. if None chunk size is set by chunking
+            ordered (bool): yield results in order of iterable. otherwise yield chunk results as they finish
+            return_exceptions (bool): yield exception of a failed item instead of raising it
+            max_in_flight (int): max chunks sent but not yet yielded. default is twice processes
+            use_shared_memory (bool): send bytes like and numpy array items (and results) not smaller than
+                shared_min_size through shared memory instead of pickle. handler gets a read only memoryview
+                or numpy array view of them without copy. bytes like results are returned as bytes
+            shared_min_size (int): min size in bytes of a buffer to send by shared memory
+            chunking (str): for iterable with len and no job_per_process. "static" makes one chunk per process.
+                "guided" sends remaining / (2 * processes) items in each chunk, so chunks get smaller toward the
+                end and a slow chunk does not leave other processes idle at the tail
+            min_chunk_size (int): min items in a guided chunk
+        """
         self.handler = handler
-        process_count = self.max_process
-        chunk_size = (len(iterable) // process_count) + 1
+        if chunking not in ("guided", "static"):
+            raise ValueError(f"invalid chunking {chunking!r}")
+        if use_shared_memory and shared_memory is None:
+            raise ImportError("python 3.8 or newer is needed for use_shared_memory")
+        size = len(iterable) if hasattr(iterable, "__len__") else None
+        guided = False
         if job_per_process is not None:
-            process_count = min(len(iterable) // job_per_process, self.max_process)
-            process_count = max(process_count, 1)
             chunk_size = job_per_process
+        elif size is not None:
+            chunk_size = (size // self.max_process) + 1
+            guided = chunking == "guided"
+        else:
+            chunk_size = self.max_thread
+        remaining = size
+        if max_in_flight is None:
+            max_in_flight = self.max_process * 2
+        iterator = iter(iterable)
+        finished = Queue()
+        pending = {}
+        blocks = {}
+        next_index = count()
+        yield_index = 0
+        abandon_mutex = Lock()
+        abandoned = False
 
-        chunk_path_list: [list] = []
-        index = 0
-        while index < len(iterable):
-            chunk_path_list.append(iterable[index:index + chunk_size])
-            index += chunk_size
+        def chunk_done(index: int, outputs):
+            with abandon_mutex:
+                if not abandoned:
+                    finished.put((index, outputs))
+                    return
+            # consumer stopped early. drop result but free its shared memory
+            if use_shared_memory and isinstance(outputs, tuple) and outputs[0] is not None:
+                _close_shared(shared_memory.SharedMemory(name=outputs[0]), unlink=True)
 
-        pool = multiprocessing.Pool(process_count)
-        logger.info(f"start make {process_count} process")
-        pool.map(func=self.thread_run, iterable=chunk_path_list)
-        pool.close()
-        pool.join()
+        def send_chunk() -> bool:
+            nonlocal remaining
+            if guided:
+                chunk = list(islice(iterator, max(-(-remaining // (2 * self.max_process)), min_chunk_size)))
+                remaining -= len(chunk)
+            else:
+                chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return False
+            index = next(next_index)
+            pending[index] = len(chunk)
+            if use_shared_memory:
+                block, chunk = _pack_shared(chunk, shared_min_size)
+                if block is not None:
+                    blocks[index] = block
+                func = _run_shared_chunk
+                args = (handler, self.max_thread, block.name if block else None, chunk, shared_min_size)
+            else:
+                func = _run_chunk
+                args = (handler, self.max_thread, chunk)
+            pool.apply_async(func, args, callback=lambda outputs: chunk_done(index, outputs),
+                             error_callback=lambda e: chunk_done(index, e))
+            return True
+
+        pool = self._get_pool(use_shared_memory)
+        completed = {}
+        try:
+            while len(pending) < max_in_flight and send_chunk():
+                pass
+            while pending:
+                index, outputs = finished.get()
+                if ordered:
+                    completed[index] = outputs
+                    ready = []
+                    while yield_index in completed:
+                        ready.append((yield_index, completed.pop(yield_index)))
+                        yield_index += 1
+                else:
+                    ready = [(index, outputs)]
+                for index, outputs in ready:
+                    chunk_length = pending.pop(index)
+                    if index in blocks:
+                        _close_shared(blocks.pop(index), unlink=True)
+                    while len(pending) < max_in_flight and send_chunk():
+                        pass
+                    if isinstance(outputs, BaseException):
+                        outputs = [(False, outputs)] * chunk_length
+                    elif use_shared_memory:
+                        outputs = _unpack_shared(*outputs)
+                    for success, value in outputs:
+                        if not success and not return_exceptions:
+                            raise value
+                        yield value
+        finally:
+            # pool is shared by all calls, so chunks left by an early stop are not killed. they finish in pool
+            # and chunk_done drops their results
+            with abandon_mutex:
+                abandoned = True
+            for block in blocks.values():
+                _close_shared(block, unlink=True)
+            if use_shared_memory:
+                while not finished.empty():
+                    index, outputs = finished.get()
+                    completed[index] = outputs
+                for outputs in completed.values():
+                    if isinstance(outputs, tuple) and outputs[0] is not None:
+                        _close_shared(shared_memory.SharedMemory(name=outputs[0]), unlink=True)
 
-    def thread_run(self, iterable: list, handler=None):
+    def thread_run(self, iterable: list, handler=None) -> list:
         """
-            for run thread
+            for run thread. return results in order of iterable (exception object for failed items)
         """
         if handler is None:
             handler = self.handler
         if not callable(handler):
             return
-        with ThreadPoolExecutor(max_workers=min(len(iterable), self.max_thread)) as executor:
-            executor.map(handler, iterable)
+        return [value for _, value in _run_chunk(handler, self.max_thread, list(iterable))]
@@ -0,0 +1,195 @@
+import gzip
+import os
+import threading
+
+import pytest
+
+from autoutils import file as file_module
+from autoutils.file import Compressions, FileCache, FileModes, copy_file, follow_file, iter_file, read_file, write_file
+
+
+def test_copy_file_to_itself_keeps_source(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(os.urandom(1000))
+    os.link(source, tmp_path / "hardlink")
+    assert not copy_file(str(source), str(source))
+    assert not copy_file(str(source), str(tmp_path / "hardlink"))
+    assert source.stat().st_size == 1000
+
+
+def test_file_mode_keeps_compressed_extension_raw(tmp_path):
+    address = str(tmp_path / "archive.tar.gz")
+    payload = gzip.compress(b"data")
+    assert write_file(address, payload, FileModes.FILE)
+    assert (tmp_path / "archive.tar.gz").read_bytes() == payload
+    assert read_file(address, FileModes.FILE) == payload
+    assert read_file(address, FileModes.FILE, Compressions.GZIP) == b"data"
+
+
+def test_atomic_fsync_covers_compressed_trailer(tmp_path, monkeypatch):
+    address = str(tmp_path / "data.gz")
+    synced_sizes = []
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        synced_sizes.append(os.fstat(fd).st_size)
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    assert write_file(address, ["line"] * 1000, atomic=True, fsync=True)
+    assert synced_sizes[0] == os.path.getsize(address)
+    assert read_file(address) == ["line"] * 1000
+
+
+def test_atomic_write_uses_current_umask(tmp_path):
+    address = str(tmp_path / "new.txt")
+    old_umask = os.umask(0o027)
+    try:
+        assert write_file(address, ["line"], atomic=True)
+    finally:
+        os.umask(old_umask)
+    assert os.stat(address).st_mode & 0o777 == 0o640
+    os.chmod(address, 0o600)
+    assert write_file(address, ["other"], atomic=True)
+    assert os.stat(address).st_mode & 0o777 == 0o600
+    assert read_file(address) == ["other"]
+
+
+def test_follow_file_yields_partial_line_on_rotation(tmp_path):
+    address = tmp_path / "app.log"
+    address.write_text("l1\nl2\npart")
+    stop_event = threading.Event()
+    lines = follow_file(str(address), from_start=True, poll_interval=0.01, stop_event=stop_event,
+                        use_inotify=False)
+    assert [next(lines), next(lines)] == ["l1", "l2"]
+    os.rename(address, tmp_path / "app.log.1")
+    address.write_text("new\n")
+    assert [next(lines), next(lines)] == ["part", "new"]
+    stop_event.set()
+    lines.close()
+
+
+def test_follow_file_restart_after_rotation_reads_new_file(tmp_path):
+    address = tmp_path / "app.log"
+    offset_address = str(tmp_path / "offset.json")
+    address.write_text("old1\n")
+    write_file(offset_address, {"inode": address.stat().st_ino, "offset": 5}, FileModes.JSON)
+    os.rename(address, tmp_path / "app.log.1")
+    address.write_text("new1\nnew2\n")
+    lines = follow_file(str(address), poll_interval=0.01, offset_address=offset_address, use_inotify=False)
+    assert [next(lines), next(lines)] == ["new1", "new2"]
+    lines.close()
+
+
+def test_copy_file_falls_back_when_zero_copy_stops(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    payload = os.urandom(100000)
+    source.write_bytes(payload)
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, "sendfile", lambda *args: 0, raising=False)
+    assert copy_file(str(source), str(tmp_path / "copy"), chunk_size=4096)
+    assert (tmp_path / "copy").read_bytes() == payload
+
+
+def test_copy_file_short_copy_fails(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    source.write_bytes(os.urandom(10000))
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, "sendfile", lambda *args: 0, raising=False)
+    monkeypatch.setattr(file_module, "_pread", lambda fd, count, position: b"")
+    assert not copy_file(str(source), str(tmp_path / "copy"))
+
+
+def test_jsonl_round_trip_and_append(tmp_path):
+    address = str(tmp_path / "records.jsonl")
+    records = [{"id": 1, "name": "علی"}, {"id": 2, "tags": ["a", "b"], "nested": {"x": None}}]
+    assert write_file(address, records, FileModes.JSONL)
+    assert read_file(address, FileModes.JSONL) == records
+    assert write_file(address, {"id": 3}, FileModes.JSONL, append=True)
+    assert write_file(address, [{"id": 4}], FileModes.JSONL, append=True)
+    assert read_file(address, FileModes.JSONL) == records + [{"id": 3}, {"id": 4}]
+
+
+def test_jsonl_skips_invalid_lines(tmp_path):
+    address = tmp_path / "records.jsonl"
+    address.write_text('{"id": 1}\nnot json\n\n{"id": 2}\n')
+    assert list(iter_file(str(address), FileModes.JSONL)) == [{"id": 1}, {"id": 2}]
+
+
+@pytest.mark.parametrize("extension, compression", [(".gz", Compressions.GZIP), (".bz2", Compressions.BZ2),
+                                                    (".xz", Compressions.XZ), (".zst", Compressions.ZSTD)])
+def test_compressed_read_write(tmp_path, extension, compression):
+    if compression == Compressions.ZSTD:
+        pytest.importorskip("zstandard")
+    lines = [f"line {index}" for index in range(1000)]
+    address = str(tmp_path / f"data{extension}")
+    assert write_file(address, lines)
+    assert read_file(address) == lines
+    assert read_file(address, compression=compression) == lines
+    assert os.path.getsize(address) < len("\n".join(lines))
+    other = str(tmp_path / "data.bin")
+    assert write_file(other, {"a": [1, 2]}, FileModes.JSON, compression)
+    assert read_file(other, FileModes.JSON, compression) == {"a": [1, 2]}
+    assert read_file(other, FileModes.JSON) is None
+
+
+@pytest.mark.parametrize("extension", [".gz", ".zst"])
+def test_compressed_append(tmp_path, extension):
+    if extension == ".zst":
+        pytest.importorskip("zstandard")
+    address = str(tmp_path / f"records.jsonl{extension}")
+    assert write_file(address, [{"id": 1}], FileModes.JSONL)
+    assert write_file(address, [{"id": 2}], FileModes.JSONL, append=True)
+    assert read_file(address, FileModes.JSONL) == [{"id": 1}, {"id": 2}]
+    address = str(tmp_path / f"lines{extension}")
+    assert write_file(address, "first")
+    assert write_file(address, "second", FileModes.APPEND)
+    assert read_file(address) == ["first", "second"]
+
+
+def test_file_cache_hits_and_invalidation(tmp_path):
+    cache = FileCache()
+    cache.racy_seconds = 0
+    address = str(tmp_path / "data.txt")
+    write_file(address, ["a", "b"])
+    assert cache.read(address) == ["a", "b"]
+    assert cache.read(address) is cache.read(address)
+    assert (cache.hits, cache.misses) == (2, 1)
+    write_file(address, ["a", "b", "c"])
+    assert cache.read(address) == ["a", "b", "c"]
+    assert cache.misses == 2
+    cache.invalidate(address)
+    assert cache.size == 0
+    assert cache.read(address) == ["a", "b", "c"]
+    assert cache.misses == 3
+    os.remove(address)
+    assert cache.read(address) is None
+    assert cache.size == 0
+
+
+def test_file_cache_racy_file_is_not_cached(tmp_path):
+    cache = FileCache()
+    address = str(tmp_path / "data.txt")
+    write_file(address, "a")
+    assert cache.read(address) == ["a"]
+    assert cache.read(address) == ["a"]
+    assert cache.hits == 0
+
+
+def test_file_cache_byte_bound(tmp_path):
+    cache = FileCache(max_bytes=250)
+    cache.racy_seconds = 0
+    addresses = [str(tmp_path / f"{index}.bin") for index in range(3)]
+    for address in addresses:
+        write_file(address, b"x" * 100, FileModes.FILE)
+    for address in addresses:
+        cache.read(address, FileModes.FILE)
+    assert cache.size == 200
+    cache.read(addresses[1], FileModes.FILE)
+    assert cache.hits == 1
+    cache.read(addresses[0], FileModes.FILE)
+    assert cache.misses == 4
+    big = str(tmp_path / "big.bin")
+    write_file(big, b"x" * 300, FileModes.FILE)
+    assert cache.read(big, FileModes.FILE) == b"x" * 300
+    assert cache.size <= 250
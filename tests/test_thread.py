@@ -0,0 +1,305 @@
+import asyncio
+import gc
+import random
+import threading
+import time
+from concurrent.futures import CancelledError
+from queue import Empty, Full
+
+import pytest
+
+from func_timeout.exceptions import FunctionTimedOut
+
+from autoutils.thread import AsyncPool, DeadlineExceeded, ProcessThreadPool, StealingTaskQueue, TaskRejected, ThreadPool, \
+    TaskOptions, task_timed_out
+
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+    return seconds
+
+
+def slow_identity(value):
+    time.sleep(0.2)
+    return value
+
+
+def block_workers(pool: ThreadPool, count: int = 1) -> threading.Event:
+    """occupy count workers of pool until returned event is set"""
+    gate = threading.Event()
+    started = threading.Semaphore(0)
+
+    def wait():
+        started.release()
+        gate.wait(10)
+
+    for _ in range(count):
+        pool.add_task(wait)
+    for _ in range(count):
+        assert started.acquire(timeout=10)
+    return gate
+
+
+def fail_on_two(value):
+    if value == 2:
+        raise ValueError(value)
+    return value
+
+
+def test_tasks_finishing_at_their_timeout():
+    """tasks ending right at timeout must not dead lock watchdog or workers"""
+    rnd = random.Random(0)
+    pool = ThreadPool(4, 400, return_future=True)
+    try:
+        futures = [pool.add_task(TaskOptions(busy, timeout=0.02), rnd.uniform(0.015, 0.025)) for _ in range(400)]
+        for future in futures:
+            assert future.wait(timeout=10)
+        counters = pool.get_stats()["counters"]
+    finally:
+        pool.shutdown(wait=False)
+    assert counters["done"] + counters["timeout"] == 400
+    assert counters["timeout"] > 0
+
+
+def test_timed_out_workers_are_bounded():
+    """timed out tasks keep running, so only max_abandoned_workers of them are replaced"""
+    release = threading.Event()
+    pool = ThreadPool(2, 20, return_future=True, max_abandoned_workers=2)
+    try:
+        threads = threading.active_count()
+        futures = [pool.add_task(TaskOptions(release.wait, timeout=0.05), 10) for _ in range(6)]
+        time.sleep(1)
+        assert threading.active_count() <= threads + 3
+        release.set()
+        for future in futures[:4]:
+            assert isinstance(future.exception(timeout=10), FunctionTimedOut)
+        for future in futures[4:]:
+            assert future.result(timeout=10) is True
+        assert pool.add_task(lambda: 1).result(timeout=10) == 1
+    finally:
+        pool.shutdown(wait=False)
+
+
+def test_task_can_check_its_timeout():
+    def loop():
+        while not task_timed_out():
+            time.sleep(0.01)
+        stopped.set()
+
+    stopped = threading.Event()
+    pool = ThreadPool(1, 2, return_future=True)
+    try:
+        future = pool.add_task(TaskOptions(loop, timeout=0.05))
+        assert stopped.wait(timeout=10)
+        assert isinstance(future.exception(timeout=10), FunctionTimedOut)
+        assert not task_timed_out()
+    finally:
+        pool.shutdown(wait=False)
+
+
+def test_process_iter_early_stop_keeps_other_callers_running():
+    """a call that stops early must not kill chunks of other calls on the shared process pool"""
+    with ProcessThreadPool(2, 2) as pool:
+        results = {}
+        other = threading.Thread(target=lambda: results.setdefault("other", pool.process_run(range(8), slow_identity)))
+        other.start()
+        time.sleep(0.05)
+        try:
+            list(pool.process_iter([1, 2], fail_on_two, 1))
+        except ValueError:
+            pass
+        other.join(timeout=10)
+        assert not other.is_alive()
+        assert results["other"] == list(range(8))
+
+
+def test_async_pool_keeps_slot_of_timed_out_sync_task():
+    """a sync task can not be stopped on timeout, so it must still count against worker_count"""
+    mutex = threading.Lock()
+    running = [0, 0]
+
+    def blocking():
+        with mutex:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.2)
+        with mutex:
+            running[0] -= 1
+
+    with AsyncPool(2, 10, return_future=True) as pool:
+        futures = [pool.add_task(TaskOptions(blocking, timeout=0.02)) for _ in range(6)]
+        for future in futures:
+            assert future.wait(timeout=10)
+    assert running[1] == 2
+    assert sum(1 for future in futures if future.exception() is not None) == 6
+
+
+def test_metrics_rate_is_per_collector():
+    with ThreadPool(2, 100) as pool:
+        first = pool.get_metrics()
+        for value in range(20):
+            pool.add_task(abs, value)
+        pool.wait_completion()
+        pool.get_metrics()
+        second = pool.get_metrics(previous=first)
+        assert second["finished"] - first["finished"] == 20
+        assert second["tasks_per_second"] > 0
+        assert second["functions"]["abs"]["counters"]["done"] == 20
+
+
+def test_async_pool_keeps_pending_tasks_alive():
+    async def wait_forever():
+        await asyncio.get_running_loop().create_future()
+
+    pool = AsyncPool(2, 10, return_future=True)
+    try:
+        future = pool.add_task(wait_forever)
+        time.sleep(0.05)
+        gc.collect()
+        assert not future.wait(timeout=0.1)
+    finally:
+        pool.shutdown(wait=False)
+
+
+def test_async_pool_failures():
+    async def stop():
+        raise asyncio.CancelledError()
+
+    with AsyncPool(2, 10, return_future=True) as pool:
+        timed_out = pool.add_task(TaskOptions(asyncio.sleep, timeout=0.01), 1)
+        stopped = pool.add_task(stop)
+        assert isinstance(timed_out.exception(timeout=5), FunctionTimedOut)
+        assert isinstance(stopped.exception(timeout=5), asyncio.CancelledError)
+
+
+def test_priority_runs_first_inside_group():
+    order = []
+    with ThreadPool(1, 20, return_future=True) as pool:
+        gate = block_workers(pool)
+        futures = [pool.add_task(TaskOptions(order.append, priority=priority), name)
+                   for name, priority in [("low", 0), ("high", 5), ("mid", 1), ("low 2", 0)]]
+        gate.set()
+        for future in futures:
+            future.result(timeout=10)
+    assert order == ["high", "mid", "low", "low 2"]
+
+
+def test_groups_take_turns():
+    order = []
+    with ThreadPool(1, 20, return_future=True) as pool:
+        gate = block_workers(pool)
+        futures = [pool.add_task(TaskOptions(order.append, group="bulk"), f"bulk {index}") for index in range(3)]
+        futures += [pool.add_task(TaskOptions(order.append, group="api", priority=index), f"api {index}")
+                    for index in range(2)]
+        gate.set()
+        for future in futures:
+            future.result(timeout=10)
+    assert order == ["bulk 0", "api 1", "bulk 1", "api 0", "bulk 2"]
+
+
+def test_deadline_of_waiting_tasks():
+    with ThreadPool(1, 20, return_future=True) as pool:
+        gate = block_workers(pool)
+        expired = pool.add_task(TaskOptions(abs, deadline=0.01), -1)
+        dropped = pool.add_task(TaskOptions(abs, deadline=0.01, drop_expired=True), -1)
+        in_time = pool.add_task(TaskOptions(abs, deadline=10), -1)
+        time.sleep(0.05)
+        gate.set()
+        assert isinstance(expired.exception(timeout=10), DeadlineExceeded)
+        assert isinstance(dropped.exception(timeout=10), CancelledError) and dropped.cancelled()
+        assert in_time.result(timeout=10) == 1
+        counters = pool.get_stats()["counters"]
+    assert (counters["expired"], counters["dropped"]) == (1, 1)
+
+
+def test_stealing_pool_runs_all_tasks():
+    with ThreadPool(4, 50, return_future=True, scheduler="stealing") as pool:
+        futures = [pool.add_task(busy, 0.0001) for _ in range(2000)]
+        pool.tasks.join()
+        assert all(future.result(timeout=10) == 0.0001 for future in futures)
+        assert pool.tasks.unfinished_tasks == 0
+        assert pool.get_stats()["counters"]["done"] == 2000
+
+
+def test_stealing_queue_bound_and_join():
+    queue = StealingTaskQueue(2)
+    queue.put(1)
+    queue.put(2)
+    assert queue.full()
+    with pytest.raises(Full):
+        queue.put_nowait(3)
+    with pytest.raises(Full):
+        queue.put(3, timeout=0.01)
+    putter = threading.Thread(target=queue.put, args=(3,))
+    putter.start()
+    time.sleep(0.05)
+    assert putter.is_alive()
+    assert queue.get_nowait() in (1, 2)
+    putter.join(timeout=10)
+    assert not putter.is_alive()
+    joiner = threading.Thread(target=queue.join)
+    joiner.start()
+    for _ in range(2):
+        queue.get_nowait()
+    with pytest.raises(Empty):
+        queue.get_nowait()
+    for _ in range(3):
+        queue.task_done()
+    joiner.join(timeout=10)
+    assert not joiner.is_alive()
+    with pytest.raises(ValueError):
+        queue.task_done()
+
+
+def test_stealing_queue_keeps_tasks_of_left_worker():
+    queue = StealingTaskQueue()
+    worker = object()
+    with pytest.raises(Empty):
+        queue.get(block=False, worker=worker)
+    for item in range(3):
+        queue.put(item)
+    queue.unregister(worker)
+    assert sorted(queue.get_nowait() for _ in range(3)) == [0, 1, 2]
+    queue.put(None)
+    assert queue.get(block=False, worker=object()) is None
+
+
+@pytest.mark.parametrize("scheduler", ["shared", "stealing"])
+@pytest.mark.parametrize("policy", ["block", "raise", "drop_oldest", "drop_newest", "caller_runs"])
+def test_reject_policies(scheduler, policy):
+    with ThreadPool(1, 1, return_future=True, scheduler=scheduler, reject_policy=policy, put_timeout=0.05) as pool:
+        gate = block_workers(pool)
+        queued = pool.add_task(abs, -1)
+        if policy in ("block", "raise"):
+            start = time.monotonic()
+            with pytest.raises(TaskRejected):
+                pool.add_task(abs, -2)
+            assert (time.monotonic() - start >= 0.05) == (policy == "block")
+            new = None
+        else:
+            new = pool.add_task(threading.get_ident)
+        if policy == "caller_runs":
+            assert new.result(timeout=1) == threading.get_ident()
+        gate.set()
+        if policy == "drop_oldest":
+            assert isinstance(queued.exception(timeout=10), TaskRejected)
+            assert new.result(timeout=10) != threading.get_ident()
+        else:
+            assert queued.result(timeout=10) == 1
+        if policy == "drop_newest":
+            assert isinstance(new.exception(timeout=10), TaskRejected)
+        assert pool.get_stats()["counters"]["rejected"] == (0 if policy == "caller_runs" else 1)
+
+
+def test_try_add_task_never_blocks():
+    with ThreadPool(1, 1, return_future=True) as pool:
+        gate = block_workers(pool)
+        queued = pool.try_add_task(abs, -1)
+        assert queued is not None
+        assert pool.try_add_task(abs, -2) is None
+        gate.set()
+        assert queued.result(timeout=10) == 1
+        pool.tasks.join()
+        assert pool.try_add_task(abs, -3).result(timeout=10) == 3